@@ -0,0 +1,9 @@
+"""
+Benchmarks for the TriTime hot paths. Run from the repository root with
+
+    python -m bench --badges 200 --years 2 --output bench_results.json
+
+A synthetic roster and punch history is generated into a temporary data
+directory (see bench.dataset), every benchmark runs against it and the
+timings are written as JSON so runs from different releases can be compared.
+"""
@@ -0,0 +1,158 @@
+import sys
+import json
+import queue
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import time
+
+from datetime import datetime, timedelta
+
+import lib.tritime as libtt
+import lib.trireport as libtr
+
+from version import VERSION
+from bench.dataset import generate_dataset
+
+
+def timed(fn, runs: int = 1) -> dict:
+    """Call fn runs times and summarize the wall clock time in ms."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'runs': runs,
+        'min_ms': min(times),
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.fmean(times),
+        'max_ms': max(times),
+    }
+
+
+def timed_each(fn, args: list) -> dict:
+    """Call fn once per item in args and summarize the per-call times."""
+    it = iter(args)
+    return timed(lambda: fn(next(it)), len(args))
+
+
+def bench_publish_data() -> dict:
+    # Only the message building and JSON serialization is timed; nothing is
+    # sent. Needs the Azure SDK installed for libazure to import.
+    try:
+        import lib.libazure as libaz
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    def publish():
+        libaz.publish_data()
+        while True:
+            try:
+                libaz.message_queue.get_nowait().to_json()
+            except queue.Empty:
+                break
+    return timed(publish)
+
+
+def run_benchmarks(data_dir: str, backend: str, samples: int,
+                   runs: int, seed: int, period_days: int = 14) -> dict:
+    rng = random.Random(seed)
+    results = {}
+    libtt.use_backend(backend, data_dir)
+    # Get the data into the state the app runs in: startup repairs it and
+    # moves every finished pay period into the archive.
+    results['startup_fix_badges'] = timed(libtt.fix_badges)
+    results['startup_archive'] = timed(
+        lambda: libtt.archive_closed_periods(period_days))
+    libtr.rollups.period_days = period_days
+    badges = libtt.get_badges()
+    out_badges = [b for b, v in badges.items() if v['status'] == 'out']
+    sample = rng.sample(out_badges, min(samples, len(out_badges)))
+    alt_keys = [k for b in sample for k in badges[b].get('alt_keys', [])]
+
+    results['get_badges'] = timed(libtt.get_badges, runs)
+    results['resolve_badge'] = timed_each(libtt.resolve_badge, alt_keys)
+    results['tabulate_badge'] = timed_each(libtt.tabulate_badge, sample)
+    # What Check Time and publish_data read: the current pay period, with
+    # the archive behind it
+    period_start = libtt.pay_period_start(datetime.now(), period_days)
+    results['read_punches_range'] = timed_each(
+        lambda b: libtt.read_punches_range(b, period_start), sample)
+    results['read_punches_history'] = timed_each(
+        lambda b: libtt.read_punches(b, history=True), sample)
+    results['rollups_refresh_cold'] = timed(libtr.rollups.refresh)
+    results['load_punch_table'] = timed(libtr.load_punch_table, runs)
+    # Punch a day past the end of the generated history
+    dt = datetime.now() + timedelta(days=1)
+    results['punch_in'] = timed_each(lambda b: libtt.punch_in(b, dt), sample)
+    dt_out = dt + timedelta(hours=2)
+    results['punch_out'] = timed_each(lambda b: libtt.punch_out(b, dt_out),
+                                      sample)
+    results['fix_badges'] = timed(libtt.fix_badges, runs)
+    report = f'{data_dir}/bench_report.xlsx'
+    # The first export builds the fact table from scratch; later ones only
+    # pick up what changed.
+    results['export_to_excel_cold'] = timed(
+        lambda: libtr.export_to_excel(report))
+    results['export_to_excel'] = timed(
+        lambda: libtr.export_to_excel(report), runs)
+    results['publish_data'] = bench_publish_data()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bench',
+        description='Time the TriTime hot paths on a synthetic dataset.')
+    parser.add_argument('--badges', type=int, default=200)
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--alt-keys', type=int, default=1)
+    parser.add_argument('--open-fraction', type=float, default=0.1)
+    parser.add_argument('--backend', default='json',
+                        choices=['json', 'sqlite', 'binary'])
+    parser.add_argument('--period-days', type=int, default=14,
+                        help='pay period length used to archive the history')
+    parser.add_argument('--samples', type=int, default=50,
+                        help='badges used for the per-badge benchmarks')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='repeats for the whole-dataset benchmarks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='tritime-bench-') as data_dir:
+        print(f'generating dataset in {data_dir}')
+        dataset = generate_dataset(data_dir, args.badges, args.years,
+                                   args.alt_keys, args.open_fraction,
+                                   seed=args.seed)
+        # run_benchmarks' use_backend copies the JSON data over
+        results = run_benchmarks(data_dir, args.backend, args.samples,
+                                 args.runs, args.seed, args.period_days)
+        libtt.use_backend('json', 'data')
+
+    output = {
+        'version': VERSION,
+        'timestamp': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'backend': args.backend,
+        'period_days': args.period_days,
+        'dataset': dataset,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(output, indent=4))
+    for name, r in results.items():
+        if 'skipped' in r:
+            print(f'{name:24} skipped: {r["skipped"]}')
+        else:
+            print(f'{name:24} median {r["median_ms"]:10.3f} ms '
+                  f'over {r["runs"]} runs')
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
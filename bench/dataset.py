@@ -0,0 +1,78 @@
+import os
+import json
+import random
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+json_dt_fmt = '%Y-%m-%d %H:%M:%S'
+
+first_names = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Casey', 'Riley', 'Morgan',
+               'Jamie', 'Avery', 'Quinn', 'Drew', 'Parker', 'Reese', 'Skyler']
+last_names = ['Smith', 'Garcia', 'Nguyen', 'Patel', 'Kim', 'Jones', 'Brown',
+              'Lopez', 'Miller', 'Davis', 'Wilson', 'Clark', 'Lewis', 'Young']
+
+
+def generate_dataset(data_dir: str, badges: int = 200, years: float = 2,
+                     alt_keys: int = 1, open_fraction: float = 0.1,
+                     sessions_per_week: int = 4,
+                     end: Optional[datetime] = None,
+                     seed: int = 0) -> dict:
+    """
+    Write a synthetic badges.json and punch_data_{badge}.json per badge into
+    data_dir, in the original JSON layout. Every badge gets about
+    sessions_per_week punches a week going back years from end, alt_keys
+    alternate keys each, and open_fraction of them are left punched in.
+    Returns a summary of what was written.
+    """
+    rng = random.Random(seed)
+    end = datetime.now().replace(microsecond=0) if end is None else end
+    start = end - timedelta(days=int(years * 365))
+    os.makedirs(data_dir, exist_ok=True)
+
+    roster = {}
+    punch_count = 0
+    for i in range(badges):
+        badge_num = f'{100000 + i}'
+        name = f'{rng.choice(first_names)} {rng.choice(last_names)} {i}'
+        is_open = rng.random() < open_fraction
+        roster[badge_num] = {
+            'display_name': name,
+            'photo_url': f'https://example.com/photos/{badge_num}.png',
+            'status': 'in' if is_open else 'out',
+            'alt_keys': [f'alt-{badge_num}-{k}' for k in range(alt_keys)],
+        }
+        punches = []
+        day = start
+        while day < end - timedelta(days=1):
+            # A few evening sessions a week, a couple of hours each
+            for weekday in sorted(rng.sample(range(7), sessions_per_week)):
+                ts_in = (day + timedelta(days=weekday, hours=17,
+                                         minutes=rng.randint(0, 45)))
+                if ts_in >= end - timedelta(days=1):
+                    break
+                ts_out = ts_in + timedelta(minutes=rng.randint(60, 240))
+                punches.append({
+                    'ts_in': ts_in.strftime(json_dt_fmt),
+                    'ts_out': ts_out.strftime(json_dt_fmt),
+                    'duration': (ts_out - ts_in).total_seconds(),
+                })
+            day += timedelta(days=7)
+        if is_open:
+            punches.append({
+                'ts_in': (end - timedelta(hours=2)).strftime(json_dt_fmt)
+            })
+        punch_count += len(punches)
+        with open(f'{data_dir}/punch_data_{badge_num}.json', 'w') as f:
+            f.write(json.dumps(punches, indent=4, sort_keys=True))
+
+    with open(f'{data_dir}/badges.json', 'w') as f:
+        f.write(json.dumps(roster, indent=4))
+    return {
+        'badges': badges,
+        'years': years,
+        'alt_keys': alt_keys,
+        'open_badges': sum(1 for b in roster.values() if b['status'] == 'in'),
+        'punches': punch_count,
+        'end': end.strftime(json_dt_fmt),
+    }
@@ -0,0 +1,229 @@
+"""
+Shift-change load simulator for the kiosk UI. Builds the real MainWindow on a
+synthetic roster and has students "scan" their badges into badge_num_input
+the way a USB scanner does: a fast burst of keystrokes followed by Enter.
+For every scan it records when the punch was committed and when the active
+badge grid was updated, measured from the moment the scan started, and
+writes percentiles to a JSON results file.
+
+Needs a display; on a headless machine run it under a virtual one:
+
+    xvfb-run -a python -m bench.kiosk --students 120 --window 120
+"""
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import time
+
+from datetime import datetime
+from typing import Optional
+
+import wx
+import main
+import lib.tritime as libtt
+import lib.trireport as libtr
+
+from version import VERSION
+from bench.dataset import generate_dataset
+
+
+def percentiles(values: list) -> dict:
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return {
+        'count': len(values),
+        'p50_ms': pct(50),
+        'p90_ms': pct(90),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'max_ms': values[-1],
+        'mean_ms': statistics.fmean(values),
+    }
+
+
+class ShiftChange:
+    """
+    Drives one shift change against frame: each badge in scans is typed in
+    at its scheduled offset (seconds from the start) one keystroke every
+    keystroke_ms, then Enter is pressed.
+    """
+    def __init__(self, frame, scans: list, keystroke_ms: int):
+        self.frame = frame
+        self.scans = scans
+        self.keystroke_ms = keystroke_ms
+        self.records: dict = {}
+        self.current: Optional[dict] = None
+        self.pending: list = []
+        self.done = 0
+        self.start = None
+        self._instrument()
+
+    def _instrument(self):
+        # Note when the punch reaches storage and when the window is ready
+        # for the next scan (the grid has been updated by then).
+        commit_punch = libtt.commit_punch
+
+        def timed_commit(badge, punch, status):
+            commit_punch(badge, punch, status)
+            if self.current is not None:
+                self.current['commit'] = time.perf_counter()
+        libtt.commit_punch = timed_commit
+
+        clear_input = self.frame.clear_input
+
+        def timed_clear():
+            clear_input()
+            if self.current is not None:
+                self.current['grid'] = time.perf_counter()
+                self.current = None
+                self.done += 1
+                wx.CallAfter(self._next)
+        self.frame.clear_input = timed_clear
+
+    def run(self):
+        self.start = time.perf_counter()
+        for idx, (offset, badge) in enumerate(self.scans):
+            wx.CallLater(max(1, int(offset * 1000)), self._arrive, idx)
+
+    def _arrive(self, idx):
+        # A student walks up; scans queue behind whoever is still scanning
+        offset, badge = self.scans[idx]
+        self.records[idx] = {
+            'badge': badge,
+            'scheduled': self.start + offset,
+            'arrived': time.perf_counter(),
+        }
+        self.pending.append(idx)
+        if self.current is None and len(self.pending) == 1:
+            self._next()
+
+    def _next(self):
+        if self.current is not None or len(self.pending) == 0:
+            return
+        idx = self.pending.pop(0)
+        record = self.current = self.records[idx]
+        record['first_key'] = time.perf_counter()
+        self._type(record, 0)
+
+    def _type(self, record: dict, pos: int):
+        text = record['badge']
+        ctrl = self.frame.badge_num_input
+        if pos < len(text):
+            ctrl.AppendText(text[pos])
+            wx.CallLater(self.keystroke_ms, self._type, record, pos + 1)
+            return
+        record['enter'] = time.perf_counter()
+        evt = wx.CommandEvent(wx.wxEVT_TEXT_ENTER, ctrl.GetId())
+        evt.SetEventObject(ctrl)
+        evt.SetString(ctrl.GetValue())
+        ctrl.GetEventHandler().ProcessEvent(evt)
+
+    def finished(self) -> bool:
+        return self.done >= len(self.scans)
+
+    def results(self) -> dict:
+        def ms(a, b):
+            return [(r[b] - r[a]) * 1000 for r in self.records.values()
+                    if a in r and b in r]
+        return {
+            'scans': len(self.scans),
+            'completed': self.done,
+            # From the scheduled scan time, so time spent waiting for the UI
+            # to get to a scan counts against it.
+            'scan_to_commit': percentiles(ms('scheduled', 'commit')),
+            'scan_to_grid': percentiles(ms('scheduled', 'grid')),
+            # Just the handling of the Enter press
+            'enter_to_commit': percentiles(ms('enter', 'commit')),
+            'enter_to_grid': percentiles(ms('enter', 'grid')),
+            'queue_wait': percentiles(ms('arrived', 'first_key')),
+        }
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.kiosk',
+        description='Simulate a shift change against the kiosk UI.')
+    parser.add_argument('--students', type=int, default=120)
+    parser.add_argument('--window', type=float, default=120,
+                        help='seconds over which everybody scans in')
+    parser.add_argument('--roster', type=int, default=300,
+                        help='badges in the synthetic roster')
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--keystroke-ms', type=int, default=8,
+                        help='time between scanner keystrokes')
+    parser.add_argument('--backend', default='json',
+                        choices=['json', 'sqlite', 'binary'])
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='kiosk_results.json')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix='tritime-kiosk-') as data_dir:
+        dataset = generate_dataset(data_dir, args.roster, args.years,
+                                   open_fraction=0, seed=args.seed)
+        libtt.use_backend(args.backend, data_dir)
+        main._app_settings = main.default_app_settings()
+        # The same startup the app does: repair, then archive finished
+        # pay periods
+        period_days = main._app_settings['pay_period_days']
+        libtt.fix_badges()
+        libtt.archive_closed_periods(period_days)
+        libtr.rollups.period_days = period_days
+
+        badges = list(libtt.get_badges().keys())
+        students = rng.sample(badges, min(args.students, len(badges)))
+        # Arrivals bunch up the way they do at the door
+        offsets = sorted(rng.uniform(0, args.window) for _ in students)
+        scans = list(zip(offsets, students))
+
+        app = wx.App()
+        frame = main.MainWindow(parent=None, id=-1)
+        frame.Show()
+        sim = ShiftChange(frame, scans, args.keystroke_ms)
+        deadline = time.perf_counter() + args.window + args.timeout
+
+        def check():
+            if sim.finished() or time.perf_counter() > deadline:
+                frame.shutdown()
+            else:
+                wx.CallLater(200, check)
+        wx.CallAfter(sim.run)
+        wx.CallLater(200, check)
+        app.MainLoop()
+        results = sim.results()
+        libtt.use_backend('json', 'data')
+
+    output = {
+        'version': VERSION,
+        'timestamp': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'wx': wx.version(),
+        'backend': args.backend,
+        'dataset': dataset,
+        'students': len(scans),
+        'window_s': args.window,
+        'keystroke_ms': args.keystroke_ms,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(output, indent=4))
+    for name, r in results.items():
+        if isinstance(r, dict) and len(r) > 0:
+            print(f'{name:16} p50 {r["p50_ms"]:9.1f} ms  '
+                  f'p95 {r["p95_ms"]:9.1f} ms  max {r["max_ms"]:9.1f} ms')
+    print(f'{results["completed"]} of {results["scans"]} scans completed; '
+          f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -4,6 +4,7 @@ import logging
 import threading
 
 from . import tritime
+from . import tristore
 
 from datetime import datetime
 from azure.servicebus import ServiceBusClient, ServiceBusMessage
@@ -117,7 +118,18 @@ def receive_subscription_messages(handler: Callable) -> None:
                         # good idea to have a backup check
                         if obj.system_id != system_id():
                             print('processing the message')
-                            handler(obj)
+                            try:
+                                handler(obj)
+                            except Exception as e:
+                                # Don't let one bad message take the
+                                # receiver down or come back forever; park
+                                # it where someone can look at it.
+                                logger.error(f'Error handling {obj.event_type} '
+                                             f'message: {e}')
+                                receiver.dead_letter_message(
+                                    msg, reason='handler error',
+                                    error_description=str(e))
+                                continue
                         print('marking message completed in queu')
                         receiver.complete_message(msg)
                 except Exception as e:
@@ -174,9 +186,15 @@ def stop() -> None:
     if sender_thread:
         sender_thread.join()
 
-def publish_data() -> None:
+def publish_data(start: Optional[datetime] = None,
+                 end: Optional[datetime] = None) -> None:
     """This system will publish its stored data to the service bus
-       so other systems can sync up to it."""
+       so other systems can sync up to it. With start/end, only punches
+       with ts_in in that range are sent, as punch_range_sync events;
+       kiosks that don't know that event type ignore it, where they'd
+       choke on anything but a list in a punch_data_sync."""
+    start_ts = None if start is None else start.strftime(tritime.json_dt_fmt)
+    end_ts = None if end is None else end.strftime(tritime.json_dt_fmt)
     badges = tritime.get_badges()
     message = TriTimeEvent(
         system_id=system_id(),
@@ -186,14 +204,30 @@ def publish_data() -> None:
         details=badges,
     )
     queue_message(message)
+    full_history = start is None and end is None
+    if full_history:
+        # Read each archive segment once rather than once per badge
+        archived = tritime.archived_punch_map()
     for num in badges.keys():
-        pd = tritime.read_punches(num)
+        details: Any
+        if full_history:
+            event_type = 'punch_data_sync'
+            details = tritime.backend().read_punches(num)
+            if num in archived:
+                details = tristore.apply_journal(archived[num], details)
+        else:
+            event_type = 'punch_range_sync'
+            details = {
+                'start': start_ts,
+                'end': end_ts,
+                'punches': tritime.read_punches_range(num, start_ts, end_ts),
+            }
         message = TriTimeEvent(
             system_id=system_id(),
             badge_num=num,
-            event_type='punch_data_sync',
+            event_type=event_type,
             ts=datetime.now(),
-            details=pd,
+            details=details,
         )
         queue_message(message)
 
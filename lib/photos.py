@@ -0,0 +1,132 @@
+import os
+import json
+import logging
+import threading
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from requests.adapters import HTTPAdapter
+
+from . import tristore
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoDownloader:
+    """
+    Keeps cached_photos/{badge}.png in step with each badge's photo_url.
+    Downloads run on a small thread pool over one pooled session, every
+    request has a timeout, and photos we already have are revalidated with
+    the ETag / Last-Modified the server gave us last time, so unchanged ones
+    aren't fetched again. decode, if given, turns the downloaded bytes into
+    the PNG bytes to store (e.g. scaled down); it runs on the worker
+    threads. Validators are kept in _photos.json next to the photos.
+    """
+    def __init__(self, photo_dir: str = 'cached_photos', max_workers: int = 8,
+                 timeout: float = 10, decode=None):
+        self.photo_dir = photo_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.decode = decode
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers,
+                              pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._meta: Optional[dict] = None
+
+    def photo_file(self, badge_num: str) -> str:
+        return f'{self.photo_dir}/{badge_num}.png'
+
+    def _meta_file(self) -> str:
+        return f'{self.photo_dir}/_photos.json'
+
+    def _load_meta(self) -> dict:
+        try:
+            with open(self._meta_file(), 'r') as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def _ensure_meta(self) -> dict:
+        # Loaded on first use, whether that's fetch or download_all
+        with self._lock:
+            if self._meta is None:
+                self._meta = self._load_meta()
+            return self._meta
+
+    def _save_meta(self):
+        with self._lock:
+            text = json.dumps(self._meta, indent=4, sort_keys=True)
+        tristore.atomic_write(self._meta_file(), text)
+
+    def fetch(self, badge_num: str, url: str) -> str:
+        """
+        Bring one badge's photo up to date. Returns 'downloaded',
+        'unchanged', 'skipped' (no URL) or 'failed'; a failure leaves any
+        photo we already had in place.
+        """
+        if not url or not url.startswith(('http://', 'https://')):
+            return 'skipped'
+        photo_meta = self._ensure_meta()
+        with self._lock:
+            meta = dict(photo_meta.get(badge_num, {}))
+        headers = {}
+        if meta.get('url') == url and os.path.exists(self.photo_file(badge_num)):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = self.session.get(url, headers=headers,
+                                        timeout=self.timeout)
+            if response.status_code == 304:
+                return 'unchanged'
+            if response.status_code != 200:
+                logger.warning(f'photo for {badge_num}: HTTP '
+                               f'{response.status_code} from {url}')
+                return 'failed'
+            data = response.content
+            if self.decode is not None:
+                data = self.decode(data)
+            tristore.atomic_write(self.photo_file(badge_num), data)
+        except Exception as e:
+            logger.warning(f'photo for {badge_num} from {url} failed: {e}')
+            return 'failed'
+        with self._lock:
+            photo_meta[badge_num] = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+        return 'downloaded'
+
+    def download_all(self, badges: dict, progress=None) -> dict:
+        """
+        Fetch the photo for every badge in badges (badge -> badge dict with
+        a photo_url). progress, if given, is called from the worker threads
+        as progress(done, total, badge_num, result). Returns the result for
+        each badge.
+        """
+        os.makedirs(self.photo_dir, exist_ok=True)
+        self._ensure_meta()
+        results = {}
+        done = 0
+
+        def work(item):
+            nonlocal done
+            badge_num, badge = item
+            result = self.fetch(badge_num, badge.get('photo_url'))
+            with self._lock:
+                results[badge_num] = result
+                done += 1
+                count = done
+            if progress is not None:
+                progress(count, len(badges), badge_num, result)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            list(pool.map(work, badges.items()))
+        self._save_meta()
+        return results
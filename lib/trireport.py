@@ -1,34 +1,126 @@
+import os
+import json
+import threading
+import numpy as np
 import pandas as pd
 import lib.tritime as tt
+import lib.tristore as ts
 
+from itertools import chain
+from datetime import date, datetime
+from typing import Optional
 
-def export_to_excel(filename='report.xlsx'):
-    # First get a list of every user in the system
+punch_table_columns = ['badge', 'display_name', 'time_in', 'time_out',
+                       'duration']
+
+
+def _closed_punch_columns(punch_data: list) -> tuple:
+    closed = [p for p in punch_data if 'ts_out' in p]
+    return ([p['ts_in'] for p in closed],
+            [p['ts_out'] for p in closed],
+            [p.get('duration') for p in closed])
+
+
+def load_punch_table(start: Optional[str] = None,
+                     end: Optional[str] = None) -> pd.DataFrame:
+    """
+    Every closed punch (archived pay periods included) as a DataFrame with
+    badge, display_name, time_in, time_out and duration columns. The time
+    columns are real datetimes, parsed in one vectorized pass. Optionally
+    limited to time_in in [start, end).
+    """
     badges = tt.get_badges()
-    # Create some empty lists to hold the data that we'll put into a DataFrame
-    bcol, dcol, tin, tout, tdiff = [], [], [], [], []
-    # Now let's loop through everybody in the system.
-    for badge_num, badge in badges.items():
-        dn = badge['display_name']
-        # Grab their punnch in/out data one by one
-        punch_data = tt.read_punches(badge_num)
-        # Now for every punch in/out pair, let's add it to our lists
-        for p in punch_data:
-            if 'ts_in' not in p or 'ts_out' not in p:
-                continue  # And flag as an error?
-            bcol.append(badge_num)
-            dcol.append(dn)
-            tin.append(p['ts_in'])
-            tout.append(p['ts_out'])
-            tdiff.append(p['duration'])
-
-    # With all the data in lists, let's create a DataFrame
-    tdf = pd.DataFrame({'badge': bcol, 'display_name': dcol,
-                        'time_in': tin, 'time_out': tout, 'duration': tdiff})
-
-    # Now we 'cast' the data to the correct types; fixing datetime here
-    tdf['time_in'] = pd.to_datetime(tdf['time_in'])
-    tdf['time_out'] = pd.to_datetime(tdf['time_out'])
+    if isinstance(tt.backend(), ts.SqliteBackend):
+        # One query does it
+        tdf = pd.DataFrame(tt.punch_rows(start, end),
+                           columns=punch_table_columns)
+    else:
+        # Read every badge's punches in bulk (in parallel when there are
+        # enough), pull them straight into columns and stitch those together
+        # afterwards, rather than building a tuple per row.
+        punch_map = tt.read_punch_map(badges.keys(), history=True)
+        cols = [_closed_punch_columns(punch_map[b]) for b in badges.keys()]
+        counts = [len(c[0]) for c in cols]
+        tdf = pd.DataFrame({
+            'badge': np.repeat(list(badges.keys()), counts),
+            'display_name': np.repeat(
+                [b['display_name'] for b in badges.values()], counts),
+            'time_in': list(chain.from_iterable(c[0] for c in cols)),
+            'time_out': list(chain.from_iterable(c[1] for c in cols)),
+            'duration': list(chain.from_iterable(c[2] for c in cols)),
+        }, columns=punch_table_columns)
+        if start is not None:
+            tdf = tdf[tdf['time_in'] >= start]
+        if end is not None:
+            tdf = tdf[tdf['time_in'] < end]
+    tdf['badge'] = tdf['badge'].astype(str)
+    tdf['display_name'] = tdf['display_name'].astype(str)
+    tdf['time_in'] = pd.to_datetime(tdf['time_in'], format=tt.json_dt_fmt)
+    tdf['time_out'] = pd.to_datetime(tdf['time_out'], format=tt.json_dt_fmt)
+    tdf['duration'] = tdf['duration'].astype('float64')
+    return tdf.reset_index(drop=True)
+
+
+def load_site_punch_table(sites: dict, start: Optional[str] = None,
+                          end: Optional[str] = None) -> pd.DataFrame:
+    """
+    Every closed punch from several systems' data directories, as the usual
+    punch table plus a system_id column. sites maps system_id to the data
+    directory holding that system's punches. Nothing is de-duplicated here;
+    see merge_site_punches.
+    """
+    frames = []
+    for system_id, site_dir in sites.items():
+        sdf = pd.DataFrame(tt.punch_rows(start, end, data_dir=site_dir),
+                           columns=punch_table_columns)
+        sdf['system_id'] = system_id
+        frames.append(sdf)
+    if len(frames) == 0:
+        frames.append(pd.DataFrame(columns=punch_table_columns + ['system_id']))
+    tdf = pd.concat(frames, ignore_index=True)
+    tdf['badge'] = tdf['badge'].astype(str)
+    tdf['display_name'] = tdf['display_name'].astype(str)
+    tdf['system_id'] = tdf['system_id'].astype(str)
+    tdf['time_in'] = pd.to_datetime(tdf['time_in'], format=tt.json_dt_fmt)
+    tdf['time_out'] = pd.to_datetime(tdf['time_out'], format=tt.json_dt_fmt)
+    tdf['duration'] = tdf['duration'].astype('float64')
+    return tdf
+
+
+def merge_site_punches(tdf: pd.DataFrame,
+                       merge_gap: pd.Timedelta = pd.Timedelta(0)) -> pd.DataFrame:
+    """
+    Collapse punches that are really the same shift recorded by more than
+    one kiosk. Per badge, any punch that starts before every earlier punch
+    has ended (plus merge_gap) is folded into the same interval; each merged
+    interval keeps the earliest time_in and latest time_out and the
+    system_id of its first punch. Done with sorts and cumulative maximums,
+    not a loop over rows.
+    """
+    if len(tdf) == 0:
+        return tdf.copy()
+    tdf = tdf.sort_values(['badge', 'time_in', 'time_out'],
+                          kind='stable').reset_index(drop=True)
+    # The latest time_out seen so far for the badge, excluding this row
+    reach = tdf.groupby('badge')['time_out'].cummax()
+    prev_reach = reach.groupby(tdf['badge']).shift()
+    starts = prev_reach.isna() | (tdf['time_in'] >= prev_reach + merge_gap)
+    merged = tdf.groupby(starts.cumsum()).agg(
+        badge=('badge', 'first'),
+        time_in=('time_in', 'min'),
+        time_out=('time_out', 'max'),
+        system_id=('system_id', 'first'),
+    )
+    # Sites may spell a name differently; use one per badge so the pivot
+    # doesn't split them.
+    names = tdf.drop_duplicates('badge').set_index('badge')['display_name']
+    merged['display_name'] = merged['badge'].map(names)
+    merged['duration'] = (
+        merged['time_out'] - merged['time_in']).dt.total_seconds()
+    return merged[punch_table_columns + ['system_id']].reset_index(drop=True)
+
+
+def add_week_columns(tdf: pd.DataFrame) -> pd.DataFrame:
     # Now let's make a new column that tells of what week of the year it is
     tdf['week_number'] = tdf['time_in'].dt.isocalendar().week
     # And because nobody likes to think of dates by week number of year (except
@@ -38,26 +130,522 @@ def export_to_excel(filename='report.xlsx'):
         tdf['time_in'] - pd.to_timedelta(tdf['time_in'].dt.dayofweek, unit='d')
     ).dt.date
     tdf['year'] = tdf['time_in'].dt.isocalendar().year
-    tdf.to_csv('test.csv', index=False)
-    tdf.to_parquet('test.parquet', index=False)
-    udf = tdf[['badge', 'display_name']].drop_duplicates()
-    # Now use the raw data to create a DataFrame that has the total time worked
-    # for each user for every week of the year.
-    wdf = (
-        tdf.drop(['display_name', 'time_in', 'time_out'], axis=1)
-        .groupby(['badge', 'year', 'week_number', 'sow'])
-        .sum()
-    ).reset_index()
-
-    # Now let's merge the two DataFrames together to get a final DataFrame that
-    # makes for a decent report
-    merged = pd.merge(wdf, udf, on=['badge'], how='left')
-    merged['duration_hours'] = merged['duration'] / 3600
-    # Last we 'pivot' the data so that the weeks are new each a column
-    finaldf = (
-        merged.pivot(index='display_name',
-                     columns='sow',
-                     values='duration_hours').fillna(0).reset_index(level=0)
-    )
-    finaldf.to_excel(filename, index=False)
+    return tdf
+
+
+# The fact table: every closed punch with its week columns, kept as one
+# Parquet file per ISO year/week under data/facts. _manifest.json records
+# what each badge's punch data looked like when it was last ingested and
+# which partitions its rows landed in.
+def _fact_dir() -> str:
+    return f'{tt.data_dir()}/facts'
+
+
+def _manifest_file() -> str:
+    return f'{_fact_dir()}/_manifest.json'
+
+
+def _partition_file(year: int, week: int) -> str:
+    return f'{_fact_dir()}/{year:04d}-W{week:02d}.parquet'
+
+
+def _read_manifest() -> dict:
+    try:
+        with open(_manifest_file(), 'r') as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {'archive': None, 'badges': {}}
+
+
+def _fact_files() -> list:
+    if not os.path.isdir(_fact_dir()):
+        return []
+    return sorted(f'{_fact_dir()}/{f}' for f in os.listdir(_fact_dir())
+                  if f.endswith('.parquet'))
+
+
+def refresh_fact_table(progress=None) -> list:
+    """
+    Bring the fact table up to date, re-ingesting only the badges whose punch
+    data changed since the last refresh. Returns those badges. progress, if
+    given, is called as progress(done, total, message) along the way.
+    """
+    os.makedirs(_fact_dir(), exist_ok=True)
+    manifest = _read_manifest()
+    archive = [os.path.basename(f) for f in tt.archive_segments()]
+    if manifest['archive'] != archive:
+        # New archive segments move punches around wholesale; start over.
+        for f in _fact_files():
+            os.remove(f)
+        manifest = {'archive': archive, 'badges': {}}
+
+    badges = tt.get_badges()
+    # Fingerprint before reading so a punch that lands mid-refresh is picked
+    # up next time rather than missed.
+    fingerprints = {b: tt.backend().punch_fingerprint(b) for b in badges}
+    stale = [b for b in badges
+             if manifest['badges'].get(b, {}).get('fingerprint')
+             != fingerprints[b]]
+    removed = [b for b in manifest['badges'] if b not in badges]
+    if len(stale) == 0 and len(removed) == 0:
+        return []
+
+    # In bulk: in parallel for file-based backends, one query for SQLite
+    punch_map = tt.read_punch_map(stale, history=True)
+    cols = [_closed_punch_columns(punch_map[b]) for b in stale]
+    counts = [len(c[0]) for c in cols]
+    new = pd.DataFrame({
+        'badge': np.repeat(stale, counts).astype(str),
+        'time_in': pd.to_datetime(
+            list(chain.from_iterable(c[0] for c in cols)),
+            format=tt.json_dt_fmt),
+        'time_out': pd.to_datetime(
+            list(chain.from_iterable(c[1] for c in cols)),
+            format=tt.json_dt_fmt),
+        'duration': pd.array(list(chain.from_iterable(c[2] for c in cols)),
+                             dtype='float64'),
+    })
+    new = add_week_columns(new)
+
+    redo = set(stale) | set(removed)
+    touched = {tuple(p) for b in redo
+               for p in manifest['badges'].get(b, {}).get('partitions', [])}
+    # Split the new rows up once rather than filtering them per partition
+    # (and per badge below), which is quadratic on a cold refresh.
+    new_by_partition = {(int(y), int(w)): part for (y, w), part in
+                        new.groupby(['year', 'week_number'], sort=False)}
+    touched |= new_by_partition.keys()
+    for idx, (year, week) in enumerate(sorted(touched)):
+        if progress is not None:
+            progress(idx, len(touched), 'Updating report data')
+        path = _partition_file(year, week)
+        parts = [new_by_partition.get((year, week), new.iloc[0:0])]
+        if os.path.exists(path):
+            old = pd.read_parquet(path)
+            parts.insert(0, old[~old['badge'].isin(redo)])
+        part = pd.concat(parts, ignore_index=True)
+        if len(part) == 0:
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        tmpfile = f'{_fact_dir()}/_{year:04d}-W{week:02d}.tmp'
+        part.to_parquet(tmpfile, index=False)
+        os.replace(tmpfile, path)
+
+    for b in removed:
+        del manifest['badges'][b]
+    partitions: dict = {b: [] for b in stale}
+    for b, y, w in new[['badge', 'year', 'week_number']].drop_duplicates(
+            ).itertuples(index=False):
+        partitions[b].append((int(y), int(w)))
+    for b in stale:
+        manifest['badges'][b] = {
+            'fingerprint': fingerprints[b],
+            'partitions': sorted(partitions[b]),
+        }
+    ts.atomic_write(_manifest_file(), json.dumps(manifest))
+    return stale
+
+
+def fact_chunks(refresh: bool = True, progress=None):
+    """
+    Yield the fact table one year/week partition at a time, with current
+    display names joined on, so callers can work through it in bounded
+    memory.
+    """
+    if refresh:
+        refresh_fact_table(progress=progress)
+    names = {num: b['display_name'] for num, b in tt.get_badges().items()}
+    files = _fact_files()
+    for idx, f in enumerate(files):
+        if progress is not None:
+            progress(idx, len(files), 'Exporting')
+        tdf = pd.read_parquet(f)
+        tdf = tdf[tdf['badge'].isin(names.keys())].copy()
+        tdf.insert(1, 'display_name', tdf['badge'].map(names))
+        yield tdf.reset_index(drop=True)
+
+
+def load_fact_table(refresh: bool = True) -> pd.DataFrame:
+    """
+    The fact table as one DataFrame, with current display names joined on.
+    """
+    chunks = list(fact_chunks(refresh))
+    if len(chunks) == 0:
+        return add_week_columns(load_punch_table().iloc[0:0].copy())
+    return pd.concat(chunks, ignore_index=True)
+
+
+def export_data(filename: str, progress=None, sites: Optional[dict] = None):
+    """
+    Export to filename in the format its extension asks for. Spreadsheets
+    get the weekly hours report; CSV and Parquet get every closed punch.
+    With sites (system_id -> data directory) the report covers all of those
+    systems, with punches recorded at more than one merged together.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if sites:
+        export_sites(filename, sites, progress)
+    elif ext == '.csv':
+        export_to_csv(filename, progress)
+    elif ext == '.parquet':
+        export_to_parquet(filename, progress)
+    else:
+        export_to_excel(filename, progress)
+
+
+def partial_export_file(filename: str) -> str:
+    root, ext = os.path.splitext(filename)
+    return f'{root}.partial{ext}'
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def export_worker(filename: str, backend_name: str, messages,
+                  sites: Optional[dict] = None, cancel=None):
+    """
+    Run export_data in a separate process so the pandas and openpyxl work
+    doesn't hold the GIL against the UI. Progress is posted to the messages
+    queue as ('progress', done, total, message) followed by either
+    ('done', filename), ('error', text) or ('cancelled', filename). The
+    output is written under a partial name and only renamed once it's
+    complete. cancel, if given, is an Event checked at every progress step,
+    so the export can stop cleanly (taking any reader processes it started
+    down with it) instead of being killed.
+    """
+    def progress(done, total, message):
+        if cancel is not None and cancel.is_set():
+            raise ExportCancelled()
+        messages.put(('progress', done, total, message))
+
+    tmpfile = partial_export_file(filename)
+    try:
+        tt.use_backend(backend_name)
+        export_data(tmpfile, progress=progress, sites=sites)
+        os.replace(tmpfile, filename)
+        messages.put(('done', filename))
+    except ExportCancelled:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        messages.put(('cancelled', filename))
+    except Exception as e:
+        messages.put(('error', str(e)))
+
+
+def export_to_csv(filename: str, progress=None):
+    # Write one partition at a time straight to the file
+    with open(filename, 'w', newline='') as f:
+        header = True
+        for tdf in fact_chunks(progress=progress):
+            tdf.to_csv(f, header=header, index=False)
+            header = False
+        if header:
+            load_fact_table(refresh=False).to_csv(f, index=False)
+    print('export complete')
+
+
+def export_to_parquet(filename: str, progress=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    try:
+        # Each partition becomes a row group in the output file
+        for tdf in fact_chunks(progress=progress):
+            table = pa.Table.from_pandas(tdf, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(filename, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if writer is None:
+            load_fact_table(refresh=False).to_parquet(filename, index=False)
+    finally:
+        if writer is not None:
+            writer.close()
+    print('export complete')
+
+
+def weekly_hours(refresh: bool = True, progress=None) -> dict:
+    """Total hours per (display_name, start of week)."""
+    totals: dict = {}
+    for tdf in fact_chunks(refresh, progress):
+        wdf = tdf.groupby(['display_name', 'sow'])['duration'].sum()
+        for key, seconds in wdf.items():
+            totals[key] = totals.get(key, 0) + seconds / 3600
+    return totals
+
+
+def export_to_excel(filename='report.xlsx', progress=None):
+    # Total time worked for each user for every week of the year, built up
+    # one partition at a time rather than from one big DataFrame.
+    write_weekly_pivot(filename, weekly_hours(progress=progress))
+    print('export complete')
+
+
+def write_weekly_pivot(filename: str, totals: dict):
+    """Write hours keyed by (display_name, start of week) as a workbook
+    with a row per name and a column per week."""
+    import openpyxl
+    names = sorted({name for name, _ in totals})
+    weeks = sorted({sow for _, sow in totals})
+    # Last we 'pivot' the data so that the weeks are each a new column. A
+    # write-only workbook streams rows out instead of holding every cell.
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['display_name'] + weeks)
+    for name in names:
+        ws.append([name] + [totals.get((name, sow), 0) for sow in weeks])
+    wb.save(filename)
+
+
+def export_sites(filename: str, sites: dict, progress=None):
+    """
+    The multi-site report: punches from every system in sites, merged by
+    merge_site_punches, written as the weekly pivot for spreadsheets or as
+    punch rows (with system_id) for CSV and Parquet.
+    """
+    if progress is not None:
+        progress(0, 2, 'Loading site data')
+    tdf = merge_site_punches(load_site_punch_table(sites))
+    if progress is not None:
+        progress(1, 2, 'Exporting')
+    tdf = add_week_columns(tdf)
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        tdf.to_csv(filename, index=False)
+    elif ext == '.parquet':
+        tdf.to_parquet(filename, index=False)
+    else:
+        wdf = tdf.groupby(['display_name', 'sow'])['duration'].sum() / 3600
+        write_weekly_pivot(filename, wdf.to_dict())
     print('export complete')
+
+
+class Rollups:
+    """
+    Running totals of seconds worked per badge per day, ISO week and pay
+    period, kept in data/rollups.json. Closed punches are added as they
+    happen; a badge whose punch data changed any other way (a sync, a
+    repair) is recomputed the next time anything asks. The archive's share
+    of the totals is worked out once per segment and kept, so recomputing a
+    badge only reads its live punches.
+    """
+    def __init__(self, period_days: int = 14):
+        self.period_days = period_days
+        # None until loaded from rollups.json
+        self._badges: Optional[dict] = None
+        self._archive: dict = self._empty_archive()
+        self._lock = threading.RLock()
+
+    def _filename(self) -> str:
+        return f'{tt.data_dir()}/rollups.json'
+
+    def _keys(self, ts_in: str) -> tuple:
+        dt = datetime.fromisoformat(ts_in)
+        year, week, _ = dt.isocalendar()
+        period = tt.pay_period_start(dt, self.period_days)
+        return (dt.strftime('%Y-%m-%d'), f'{year}-W{week:02d}',
+                period.strftime('%Y-%m-%d'))
+
+    @staticmethod
+    def _empty_archive() -> dict:
+        return {'segments': [], 'end': None, 'badges': {}}
+
+    def _load(self) -> dict:
+        try:
+            with open(self._filename(), 'r') as f:
+                data = json.loads(f.read())
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            data = {}
+        if data.get('period_days') != self.period_days:
+            # Period boundaries moved; every period total is wrong.
+            data = {'badges': {}}
+        self._badges = data['badges']
+        self._archive = data.get('archive', self._empty_archive())
+        return self._badges
+
+    def _loaded(self) -> dict:
+        if self._badges is None:
+            return self._load()
+        return self._badges
+
+    def save(self):
+        with self._lock:
+            if self._badges is None:
+                return
+            ts.atomic_write(self._filename(), json.dumps({
+                'period_days': self.period_days,
+                'badges': self._badges,
+                'archive': self._archive,
+            }))
+
+    def _add(self, entry: dict, punch: dict, groups=('days', 'weeks',
+                                                     'periods')):
+        seconds = punch.get('duration') or 0
+        for group, key in zip(('days', 'weeks', 'periods'),
+                              self._keys(punch['ts_in'])):
+            if group in groups:
+                totals = entry[group]
+                totals[key] = totals.get(key, 0) + seconds
+
+    def _refresh_archive(self) -> bool:
+        """Fold any new archive segments into the archive's totals. Returns
+        True if they changed."""
+        index = tt.archive_index()
+        names = [os.path.basename(f) for f in index]
+        done = self._archive['segments']
+        if done == names:
+            return False
+        if not set(done) <= set(names):
+            # Segments went away; start over
+            self._archive = self._empty_archive()
+            done = []
+        for filename, info in index.items():
+            if os.path.basename(filename) in done:
+                continue
+            segment = tt.archived_segment(filename)
+            start = datetime.strptime(segment['start'], tt.json_dt_fmt)
+            end = datetime.strptime(segment['end'], tt.json_dt_fmt)
+            # A segment is one pay period; its totals are the period totals
+            # as long as the period length hasn't changed since.
+            whole_period = (end - start).days == self.period_days
+            for badge, punches in segment['punches'].items():
+                entry = self._archive['badges'].setdefault(
+                    badge, {'days': {}, 'weeks': {}, 'periods': {}})
+                groups = ('days', 'weeks') if whole_period else \
+                    ('days', 'weeks', 'periods')
+                for p in punches:
+                    self._add(entry, p, groups)
+                if whole_period:
+                    key = start.strftime('%Y-%m-%d')
+                    entry['periods'][key] = (entry['periods'].get(key, 0)
+                                             + segment['totals'][badge])
+            if self._archive['end'] is None or \
+                    info['end'] > self._archive['end']:
+                self._archive['end'] = info['end']
+        self._archive['segments'] = names
+        return True
+
+    def _rebuild_badge(self, badge: str, fingerprint: str):
+        base = self._archive['badges'].get(badge, {})
+        entry: dict = {'fingerprint': fingerprint}
+        for group in ('days', 'weeks', 'periods'):
+            entry[group] = dict(base.get(group, {}))
+        live = tt.backend().read_punches(badge)
+        # A punch can still be in the live data after it was archived (see
+        # archive_closed_periods); count it once.
+        archive_end = self._archive['end']
+        old = [p['ts_in'] for p in live if archive_end is not None
+               and p['ts_in'] < archive_end]
+        archived = set()
+        if len(old) > 0:
+            archived = {p['ts_in'] for p in
+                        tt.archived_punches(badge, old[0], archive_end)}
+        for p in live:
+            if 'ts_out' in p and p['ts_in'] not in archived:
+                self._add(entry, p)
+        self._loaded()[badge] = entry
+
+    def refresh(self) -> list:
+        """Recompute any badge whose punch data changed behind our back.
+        Returns the badges that were recomputed."""
+        with self._lock:
+            totals = self._loaded()
+            if self._refresh_archive():
+                # Every badge's totals start from the archive's
+                totals.clear()
+            badges = tt.get_badges()
+            stale = []
+            for badge in badges:
+                fingerprint = tt.backend().punch_fingerprint(badge)
+                entry = totals.get(badge)
+                if entry is None or entry['fingerprint'] != fingerprint:
+                    self._rebuild_badge(badge, fingerprint)
+                    stale.append(badge)
+            removed = [b for b in totals if b not in badges]
+            for badge in removed:
+                del totals[badge]
+            if len(stale) > 0 or len(removed) > 0:
+                self.save()
+            return stale
+
+    def record_punch(self, badge: str, punch):
+        """Punch listener: fold a freshly closed punch into the totals. A
+        punch in adds nothing, but the badge's punch data has still changed,
+        so the fingerprint is brought up to date rather than the badge being
+        recomputed on the next query."""
+        with self._lock:
+            if self._badges is None:
+                # Not loaded yet; the next refresh picks the punch up.
+                return
+            entry = self._badges.get(badge)
+            if punch is None or entry is None:
+                self._badges.pop(badge, None)
+                return
+            if 'ts_out' in punch:
+                self._add(entry, punch)
+            entry['fingerprint'] = tt.backend().punch_fingerprint(badge)
+
+    def hours(self, badge: str, start: Optional[date] = None,
+              end: Optional[date] = None) -> float:
+        """Hours worked by badge on punches starting in [start, end)."""
+        first = None if start is None else start.strftime('%Y-%m-%d')
+        last = None if end is None else end.strftime('%Y-%m-%d')
+        with self._lock:
+            self.refresh()
+            entry = self._loaded().get(badge)
+            if entry is None:
+                return 0.0
+            seconds = sum(v for k, v in entry['days'].items()
+                          if (first is None or k >= first)
+                          and (last is None or k < last))
+        return seconds / 3600
+
+    def period_hours(self, badge: str, period: Optional[date] = None) -> float:
+        """Hours worked by badge in the pay period containing period
+        (today if not given)."""
+        key = self._period_key(period)
+        with self._lock:
+            self.refresh()
+            entry = self._loaded().get(badge)
+            return 0.0 if entry is None else entry['periods'].get(key, 0) / 3600
+
+    def week_hours(self, badge: str, year: int, week: int) -> float:
+        with self._lock:
+            self.refresh()
+            entry = self._loaded().get(badge)
+            if entry is None:
+                return 0.0
+            return entry['weeks'].get(f'{year}-W{week:02d}', 0) / 3600
+
+    def _period_key(self, period: Optional[date] = None) -> str:
+        period = datetime.now() if period is None else period
+        if not isinstance(period, datetime):
+            period = datetime(period.year, period.month, period.day)
+        start = tt.pay_period_start(period, self.period_days)
+        return start.strftime('%Y-%m-%d')
+
+    def leaderboard(self, period: Optional[date] = None) -> list:
+        """(badge, display_name, hours) for the pay period containing period
+        (today if not given), most hours first."""
+        key = self._period_key(period)
+        with self._lock:
+            self.refresh()
+            badges = tt.get_badges()
+            board = [(b, badges[b]['display_name'],
+                      entry['periods'].get(key, 0) / 3600)
+                     for b, entry in self._loaded().items() if b in badges]
+        return sorted(board, key=lambda x: (-x[2], x[1]))
+
+
+rollups = Rollups()
+tt.add_punch_listener(rollups.record_punch)
+
+
+def hours(badge: str, start: Optional[date] = None,
+          end: Optional[date] = None) -> float:
+    return rollups.hours(badge, start, end)
+
+
+def leaderboard(period: Optional[date] = None) -> list:
+    return rollups.leaderboard(period)
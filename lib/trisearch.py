@@ -0,0 +1,59 @@
+class NameIndex:
+    """
+    Substring search over badge display names, case-folded. Every name is
+    broken into its 1-, 2- and 3-character grams up front; a query only has
+    to intersect the posting lists for its grams and then confirm the few
+    candidates left, rather than scan every name. Results come back as
+    badge numbers in display name order. generation is whatever the caller
+    uses to tell when badges has changed since the index was built.
+    """
+    gram_size = 3
+
+    def __init__(self, badges: dict, generation=None):
+        self.source = badges
+        self.generation = generation
+        ordered = sorted(badges.items(), key=lambda x: x[1]['display_name'])
+        self.badge_nums = [num for num, _ in ordered]
+        self.names = [b['display_name'].casefold() for _, b in ordered]
+        self.postings: dict = {}
+        for idx, name in enumerate(self.names):
+            for gram in self._grams(name, self.gram_size):
+                self.postings.setdefault(gram, []).append(idx)
+        # The last query and its matches, so typing another character only
+        # has to filter what's already been found.
+        self._last = ('', list(range(len(self.names))))
+
+    @staticmethod
+    def _grams(text: str, size: int) -> set:
+        grams: set = set()
+        for n in range(1, size + 1):
+            grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+        return grams
+
+    def _candidates(self, query: str) -> list:
+        last_query, last_matches = self._last
+        if last_query and query.startswith(last_query):
+            return last_matches
+        n = min(len(query), self.gram_size)
+        # Only the grams of the longest size are needed; the shorter ones
+        # are implied by them.
+        grams = {query[i:i + n] for i in range(len(query) - n + 1)}
+        postings = sorted((self.postings.get(g, []) for g in grams), key=len)
+        if len(postings[0]) == 0:
+            return []
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates.intersection_update(p)
+            if len(candidates) == 0:
+                return []
+        return sorted(candidates)
+
+    def search(self, query: str) -> list:
+        query = query.strip().casefold()
+        if query == '':
+            matches = list(range(len(self.names)))
+        else:
+            matches = [idx for idx in self._candidates(query)
+                       if query in self.names[idx]]
+        self._last = (query, matches)
+        return [self.badge_nums[idx] for idx in matches]
@@ -0,0 +1,933 @@
+import os
+import json
+import math
+import mmap
+import bisect
+import struct
+import logging
+import sqlite3
+import threading
+import multiprocessing
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import BinaryIO, Optional
+
+json_dt_fmt = '%Y-%m-%d %H:%M:%S'
+
+logger = logging.getLogger(__name__)
+
+# Punches are appended to a per-badge journal (one JSON record per line) and
+# folded into the punch_data_{badge}.json snapshot once the journal has this
+# many records in it.
+journal_compact_threshold = 64
+
+# Bulk reads of at least this many bytes of punch files are spread over
+# worker processes, one per parallel_read_bytes_per_worker up to a process
+# per core (decoding is CPU bound, so threads wouldn't help). JSON decodes
+# at roughly 100 MB/s a core, and starting the processes takes around half
+# a second, so anything smaller is quicker to read here.
+parallel_read_min_bytes = 64 * 2**20
+parallel_read_bytes_per_worker = 32 * 2**20
+
+
+def atomic_write(filename: str, text):
+    """Replace filename with text (str or bytes) so readers only ever see
+    the old or the new contents, never a half-written file."""
+    tmpfile = f'{filename}.tmp'
+    mode = 'wb' if isinstance(text, bytes) else 'w'
+    with open(tmpfile, mode) as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpfile, filename)
+
+
+class StorageBackend:
+    """
+    Everything lib/tritime needs from persistent storage. A punch is a dict
+    with a 'ts_in' and, once closed, 'ts_out' and 'duration' keys.
+    """
+    def get_badges(self) -> dict:
+        raise NotImplementedError
+
+    def store_badges(self, data: dict):
+        raise NotImplementedError
+
+    def read_punches(self, badge: str) -> list:
+        raise NotImplementedError
+
+    def write_punches(self, badge: str, punch_data: list):
+        raise NotImplementedError
+
+    def read_punches_range(self, badge: str, start: Optional[str] = None,
+                           end: Optional[str] = None) -> list:
+        """The badge's punches with ts_in in [start, end), sorted."""
+        punch_data = self.read_punches(badge)
+        return punch_data[punch_slice(punch_data, start, end)]
+
+    def read_punch_map(self, badges, raw: bool = False) -> dict:
+        """badge -> punches for every badge in badges, as read_punches (or
+        read_raw_punches with raw) would return them."""
+        read = self.read_raw_punches if raw else self.read_punches
+        return {badge: read(badge) for badge in badges}
+
+    def read_raw_punches(self, badge: str) -> list:
+        """Punches in the order they are stored, for integrity checks."""
+        return self.read_punches(badge)
+
+    def punch_badges(self) -> set:
+        """Every badge number that has punch data stored."""
+        raise NotImplementedError
+
+    def punch_fingerprint(self, badge: str) -> str:
+        """A cheap value that changes whenever the badge's punches do."""
+        raise NotImplementedError
+
+    def damaged_records(self, badge: str) -> list:
+        """Line numbers of stored records that can't be read back."""
+        return []
+
+    def append_punch(self, badge: str, punch: dict):
+        """Add a new punch, or update the existing one with the same ts_in."""
+        raise NotImplementedError
+
+    def commit_punch(self, badge: str, punch: dict, status: str):
+        """Record one punch and the badge's resulting status together."""
+        self.commit_punches({badge: punch}, {badge: status})
+
+    def commit_punches(self, punches: dict, statuses: dict):
+        """
+        Record a punch for each badge in punches and apply every status in
+        statuses, writing the badge registry only once.
+        """
+        for badge, punch in punches.items():
+            self.append_punch(badge, punch)
+        badges = self.get_badges()
+        for badge, status in statuses.items():
+            badges[badge]['status'] = status
+        self.store_badges(badges)
+
+    def last_punch(self, badge: str):
+        punch_data = self.read_punches(badge)
+        return punch_data[-1] if len(punch_data) > 0 else None
+
+    def compact(self, badge: str):
+        return
+
+    def punch_rows(self, start: Optional[str] = None,
+                   end: Optional[str] = None) -> list:
+        """
+        Every closed punch as (badge, display_name, ts_in, ts_out, duration)
+        tuples, optionally limited to ts_in in [start, end).
+        """
+        rows = []
+        for badge_num, badge in self.get_badges().items():
+            for p in self.read_punches(badge_num):
+                if 'ts_out' not in p:
+                    continue
+                if start is not None and p['ts_in'] < start:
+                    continue
+                if end is not None and p['ts_in'] >= end:
+                    continue
+                rows.append((badge_num, badge['display_name'], p['ts_in'],
+                             p['ts_out'], p.get('duration')))
+        return rows
+
+    def close(self):
+        return
+
+
+def punch_slice(punch_data: list, start: Optional[str] = None,
+                 end: Optional[str] = None) -> slice:
+    # punch_data is sorted by ts_in, so the range is a contiguous run
+    lo = 0 if start is None else bisect.bisect_left(
+        punch_data, start, key=lambda p: p['ts_in'])
+    hi = len(punch_data) if end is None else bisect.bisect_left(
+        punch_data, end, key=lambda p: p['ts_in'])
+    return slice(lo, hi)
+
+
+class BadgeRegistry:
+    """
+    Holds the parsed badges.json in memory. The file is only re-read when its
+    size or modification time changes, so edits made by the Azure receiver or
+    by hand are still picked up, and store() writes straight through.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.reads = 0
+        self._badges: Optional[dict] = None
+        self._stamp: Optional[tuple] = None
+        self._lock = threading.RLock()
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self) -> dict:
+        with self._lock:
+            stamp = self._file_stamp()
+            if stamp is None:
+                empty: dict = {}
+                self.store(empty)
+                return empty
+            badges = self._badges
+            if badges is None or stamp != self._stamp:
+                with open(self.filename, 'r') as f:
+                    badges = self._badges = json.loads(f.read())
+                self._stamp = stamp
+                self.reads += 1
+            return badges
+
+    def store(self, data: dict):
+        with self._lock:
+            atomic_write(self.filename,
+                         json.dumps(data, indent=4, sort_keys=True))
+            self._badges = data
+            self._stamp = self._file_stamp()
+
+    def invalidate(self):
+        with self._lock:
+            self._badges = None
+            self._stamp = None
+
+
+class JsonBackend(StorageBackend):
+    """
+    The original layout: badges.json plus a punch_data_{badge}.json snapshot
+    and punch_journal_{badge}.jsonl journal per badge.
+    """
+    # Badges whose parsed punches are kept for range reads
+    range_cache_size = 32
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.registry = BadgeRegistry(f'{data_dir}/badges.json')
+        # badge -> (fingerprint, sorted punches, ts_in keys) for range reads,
+        # least recently used first
+        self._range_cache: OrderedDict = OrderedDict()
+        self._range_lock = threading.Lock()
+
+    def get_badges(self) -> dict:
+        return self.registry.get()
+
+    def store_badges(self, data: dict):
+        self.registry.store(data)
+
+    def _snapshot_file(self, badge: str) -> str:
+        return f'{self.data_dir}/punch_data_{badge}.json'
+
+    def _journal_file(self, badge: str) -> str:
+        return f'{self.data_dir}/punch_journal_{badge}.jsonl'
+
+    def _parse_journal(self, badge: str) -> tuple:
+        """The journal's records, and the line numbers of any that couldn't
+        be decoded (a torn line from a crash mid-append)."""
+        journal = self._journal_file(badge)
+        if not os.path.exists(journal):
+            return [], []
+        records = []
+        damaged = []
+        with open(journal, 'r') as f:
+            for num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    damaged.append(num)
+        return records, damaged
+
+    def _read_journal(self, badge: str) -> list:
+        # Skip a damaged line rather than stopping at it; whatever was
+        # appended after it is still good.
+        records, damaged = self._parse_journal(badge)
+        if len(damaged) > 0:
+            logger.warning(f'{self._journal_file(badge)}: skipped unreadable '
+                           f'line(s) {damaged}')
+        return records
+
+    def damaged_records(self, badge: str) -> list:
+        return self._parse_journal(badge)[1]
+
+    def read_raw_punches(self, badge: str) -> list:
+        datafile = self._snapshot_file(badge)
+        if os.path.exists(datafile):
+            with open(datafile, 'r') as f:
+                punch_data = json.loads(f.read())
+        else:
+            punch_data = []
+        # Journal records are updates to punches, not punches of their own:
+        # fold each into the snapshot record with the same ts_in, so every
+        # punch appears once and only the snapshot's order is on show.
+        position = {p.get('ts_in'): idx for idx, p in enumerate(punch_data)
+                    if isinstance(p, dict)}
+        new: dict = {}
+        for rec in self._read_journal(badge):
+            ts_in = rec.get('ts_in') if isinstance(rec, dict) else None
+            if ts_in is None:
+                punch_data.append(rec)
+            elif ts_in in position:
+                punch_data[position[ts_in]].update(rec)
+            else:
+                new.setdefault(ts_in, {}).update(rec)
+        keys: list = [p.get('ts_in') if isinstance(p, dict) else None
+                      for p in punch_data]
+        if all(isinstance(k, str) for k in keys) and keys == sorted(keys):
+            return apply_journal(punch_data, list(new.values()))
+        return punch_data + sorted(new.values(), key=lambda x: x['ts_in'])
+
+    def read_punches(self, badge: str) -> list:
+        datafile = self._snapshot_file(badge)
+        if os.path.exists(datafile):
+            with open(datafile, 'r') as f:
+                punch_data = json.loads(f.read())
+        else:
+            punch_data = []
+        # Sort by the ts_in property
+        punch_data = sorted(punch_data, key=lambda x: x['ts_in'])
+        return apply_journal(punch_data, self._read_journal(badge))
+
+    def read_punches_range(self, badge: str, start: Optional[str] = None,
+                           end: Optional[str] = None) -> list:
+        # Parsing the files is the expensive part, so keep the sorted punches
+        # and their keys around until the files change.
+        fingerprint = self.punch_fingerprint(badge)
+        with self._range_lock:
+            cached = self._range_cache.get(badge)
+            if cached is not None:
+                self._range_cache.move_to_end(badge)
+        if cached is None or cached[0] != fingerprint:
+            punch_data = self.read_punches(badge)
+            cached = (fingerprint, punch_data,
+                      [p['ts_in'] for p in punch_data])
+            with self._range_lock:
+                self._range_cache[badge] = cached
+                self._range_cache.move_to_end(badge)
+                while len(self._range_cache) > self.range_cache_size:
+                    self._range_cache.popitem(last=False)
+        _, punch_data, keys = cached
+        lo = 0 if start is None else bisect.bisect_left(keys, start)
+        hi = len(keys) if end is None else bisect.bisect_left(keys, end)
+        # Copies, so callers can't change what's cached
+        return [dict(p) for p in punch_data[lo:hi]]
+
+    def _punch_files(self, badge: str) -> list:
+        return [self._snapshot_file(badge), self._journal_file(badge)]
+
+    def _stored_bytes(self, badges: list) -> int:
+        total = 0
+        for badge in badges:
+            for filename in self._punch_files(badge):
+                try:
+                    total += os.stat(filename).st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def read_punch_map(self, badges, raw: bool = False) -> dict:
+        badges = list(badges)
+        # A daemon process can't start workers of its own
+        if (os.cpu_count() or 1) < 2 or \
+                multiprocessing.current_process().daemon:
+            return super().read_punch_map(badges, raw)
+        stored = self._stored_bytes(badges)
+        if stored < parallel_read_min_bytes:
+            return super().read_punch_map(badges, raw)
+        workers = min(os.cpu_count() or 1,
+                      math.ceil(stored / parallel_read_bytes_per_worker))
+        size = math.ceil(len(badges) / (workers * 4))
+        chunks = [badges[i:i + size] for i in range(0, len(badges), size)]
+        # Spawned, so the workers don't inherit locks held by our threads
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=context) as pool:
+            results = pool.map(_read_punch_chunk,
+                               [type(self)] * len(chunks),
+                               [self.data_dir] * len(chunks),
+                               chunks, [raw] * len(chunks))
+            punch_map: dict = {}
+            for chunk, punches in zip(chunks, results):
+                punch_map.update(zip(chunk, punches))
+        return punch_map
+
+    def _badges_with_files(self, prefix: str, suffix: str) -> set:
+        if not os.path.isdir(self.data_dir):
+            return set()
+        return {f[len(prefix):-len(suffix)] for f in os.listdir(self.data_dir)
+                if f.startswith(prefix) and f.endswith(suffix)}
+
+    def punch_badges(self) -> set:
+        return (self._badges_with_files('punch_data_', '.json')
+                | self._badges_with_files('punch_journal_', '.jsonl'))
+
+    @staticmethod
+    def _file_fingerprint(filename: str) -> str:
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return '-'
+        return f'{st.st_mtime_ns}:{st.st_size}'
+
+    def punch_fingerprint(self, badge: str) -> str:
+        return '/'.join([
+            self._file_fingerprint(self._snapshot_file(badge)),
+            self._file_fingerprint(self._journal_file(badge)),
+        ])
+
+    def write_punches(self, badge: str, punch_data: list):
+        punch_data = sorted(punch_data, key=lambda x: x['ts_in'])
+        atomic_write(self._snapshot_file(badge),
+                     json.dumps(punch_data, indent=4, sort_keys=True))
+        # The snapshot now holds everything, so the journal is spent.
+        if os.path.exists(self._journal_file(badge)):
+            os.remove(self._journal_file(badge))
+
+    def append_punch(self, badge: str, punch: dict):
+        journal = self._journal_file(badge)
+        with open(journal, 'ab') as f:
+            # A crash mid-append can leave the last line without its newline;
+            # end it so this record doesn't get glued onto it.
+            if f.tell() > 0:
+                with open(journal, 'rb') as tail:
+                    tail.seek(-1, os.SEEK_END)
+                    if tail.read(1) != b'\n':
+                        f.write(b'\n')
+            f.write((json.dumps(punch, sort_keys=True) + '\n').encode())
+            f.flush()
+            os.fsync(f.fileno())
+        # Damaged lines count too, so compaction (which drops them) still
+        # comes round.
+        records, damaged = self._parse_journal(badge)
+        if len(records) + len(damaged) >= journal_compact_threshold:
+            self.compact(badge)
+
+    def compact(self, badge: str):
+        """Fold the journal into the snapshot file."""
+        self.write_punches(badge, self.read_punches(badge))
+
+
+def _read_punch_chunk(backend_class, data_dir: str, badges: list,
+                      raw: bool) -> list:
+    # Runs in a worker process for JsonBackend.read_punch_map
+    store = backend_class(data_dir)
+    read = store.read_raw_punches if raw else store.read_punches
+    return [read(badge) for badge in badges]
+
+
+def apply_journal(punch_data: list, records: list) -> list:
+    # Each journal record is a whole punch keyed by its ts_in; a record for a
+    # ts_in we already have (a punch out) updates it in place, anything else
+    # is a new punch and gets inserted in ts_in order.
+    keys = [p['ts_in'] for p in punch_data]
+    for rec in records:
+        idx = bisect.bisect_left(keys, rec['ts_in'])
+        if idx < len(keys) and keys[idx] == rec['ts_in']:
+            punch_data[idx].update(rec)
+        else:
+            keys.insert(idx, rec['ts_in'])
+            punch_data.insert(idx, dict(rec))
+    return punch_data
+
+
+_sqlite_schema = """
+CREATE TABLE IF NOT EXISTS badges (
+    badge TEXT PRIMARY KEY,
+    display_name TEXT NOT NULL,
+    photo_url TEXT,
+    status TEXT NOT NULL DEFAULT 'out',
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS alt_keys (
+    alt_key TEXT NOT NULL,
+    badge TEXT NOT NULL REFERENCES badges(badge) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS alt_keys_alt_key ON alt_keys(alt_key);
+CREATE TABLE IF NOT EXISTS punches (
+    badge TEXT NOT NULL,
+    ts_in TEXT NOT NULL,
+    ts_out TEXT,
+    duration REAL,
+    PRIMARY KEY (badge, ts_in)
+);
+CREATE INDEX IF NOT EXISTS punches_ts_in ON punches(ts_in);
+-- Bumped on every change to a badge's punches, for punch_fingerprint
+CREATE TABLE IF NOT EXISTS punch_versions (
+    badge TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS punches_insert AFTER INSERT ON punches BEGIN
+    INSERT INTO punch_versions (badge, version) VALUES (NEW.badge, 1)
+        ON CONFLICT (badge) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS punches_update AFTER UPDATE ON punches BEGIN
+    INSERT INTO punch_versions (badge, version) VALUES (OLD.badge, 1)
+        ON CONFLICT (badge) DO UPDATE SET version = version + 1;
+    INSERT INTO punch_versions (badge, version) VALUES (NEW.badge, 1)
+        ON CONFLICT (badge) DO UPDATE SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS punches_delete AFTER DELETE ON punches BEGIN
+    INSERT INTO punch_versions (badge, version) VALUES (OLD.badge, 1)
+        ON CONFLICT (badge) DO UPDATE SET version = version + 1;
+END;
+"""
+
+# Badge keys that get their own column; anything else rides along in 'extra'.
+_badge_columns = ('display_name', 'photo_url', 'status')
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Everything in one SQLite database in WAL mode, so a punch is a single
+    transaction and range queries over punches can use an index.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        self._conn.executescript(_sqlite_schema)
+        self._badges: Optional[dict] = None
+        self._data_version: Optional[int] = None
+
+    def _current_data_version(self):
+        # data_version changes whenever another connection commits, which
+        # lets us keep the badge dict cached like the JSON registry does.
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get_badges(self) -> dict:
+        with self._lock:
+            version = self._current_data_version()
+            if self._badges is not None and version == self._data_version:
+                return self._badges
+            badges = {}
+            rows = self._conn.execute(
+                'SELECT badge, display_name, photo_url, status, extra '
+                'FROM badges'
+            )
+            for num, display_name, photo_url, status, extra in rows:
+                badge = json.loads(extra) if extra else {}
+                badge.update({'display_name': display_name,
+                              'photo_url': photo_url,
+                              'status': status})
+                badges[num] = badge
+            rows = self._conn.execute(
+                'SELECT badge, alt_key FROM alt_keys ORDER BY rowid'
+            )
+            for num, alt_key in rows:
+                badges[num].setdefault('alt_keys', []).append(alt_key)
+            self._badges = badges
+            self._data_version = version
+            return badges
+
+    def store_badges(self, data: dict):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM alt_keys')
+            self._conn.execute('DELETE FROM badges')
+            for num, badge in data.items():
+                extra = {k: v for k, v in badge.items()
+                         if k not in _badge_columns and k != 'alt_keys'}
+                self._conn.execute(
+                    'INSERT INTO badges VALUES (?, ?, ?, ?, ?)',
+                    (num, badge['display_name'], badge.get('photo_url'),
+                     badge.get('status', 'out'),
+                     json.dumps(extra) if extra else None)
+                )
+                self._conn.executemany(
+                    'INSERT INTO alt_keys VALUES (?, ?)',
+                    [(k, num) for k in badge.get('alt_keys', [])]
+                )
+            self._badges = data
+            self._data_version = self._current_data_version()
+
+    @staticmethod
+    def _punch_dict(ts_in, ts_out, duration) -> dict:
+        punch = {'ts_in': ts_in}
+        if ts_out is not None:
+            punch['ts_out'] = ts_out
+            punch['duration'] = duration
+        return punch
+
+    def punch_badges(self) -> set:
+        with self._lock:
+            rows = self._conn.execute('SELECT DISTINCT badge FROM punches')
+            return {r[0] for r in rows}
+
+    def punch_fingerprint(self, badge: str) -> str:
+        # The version counts every change the triggers have seen; the
+        # summary tells a rebuilt database (versions starting over) apart.
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT (SELECT version FROM punch_versions WHERE badge = ?), '
+                'count(*), count(ts_out), max(ts_in), max(ts_out), '
+                'total(duration) FROM punches WHERE badge = ?', (badge, badge)
+            ).fetchone()
+            return json.dumps(row)
+
+    def read_punches(self, badge: str) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT ts_in, ts_out, duration FROM punches '
+                'WHERE badge = ? ORDER BY ts_in', (badge,)
+            )
+            return [self._punch_dict(*r) for r in rows]
+
+    def read_punch_map(self, badges, raw: bool = False) -> dict:
+        # One query for the lot; the table has no stored order of its own
+        # for raw to preserve.
+        punch_map: dict = {badge: [] for badge in badges}
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT badge, ts_in, ts_out, duration FROM punches '
+                'ORDER BY badge, ts_in')
+            for badge, ts_in, ts_out, duration in rows:
+                if badge in punch_map:
+                    punch_map[badge].append(
+                        self._punch_dict(ts_in, ts_out, duration))
+        return punch_map
+
+    def read_punches_range(self, badge: str, start: Optional[str] = None,
+                           end: Optional[str] = None) -> list:
+        sql = 'SELECT ts_in, ts_out, duration FROM punches WHERE badge = ?'
+        params = [badge]
+        if start is not None:
+            sql += ' AND ts_in >= ?'
+            params.append(start)
+        if end is not None:
+            sql += ' AND ts_in < ?'
+            params.append(end)
+        with self._lock:
+            rows = self._conn.execute(sql + ' ORDER BY ts_in', params)
+            return [self._punch_dict(*r) for r in rows]
+
+    def write_punches(self, badge: str, punch_data: list):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM punches WHERE badge = ?',
+                               (badge,))
+            self._conn.executemany(
+                'INSERT INTO punches VALUES (?, ?, ?, ?)',
+                [(badge, p['ts_in'], p.get('ts_out'), p.get('duration'))
+                 for p in punch_data]
+            )
+
+    def _upsert_punch(self, badge: str, punch: dict):
+        # Only overwrite the columns the record actually carries, matching the
+        # dict.update() semantics of the JSON journal.
+        cols = [c for c in ('ts_out', 'duration') if c in punch]
+        updates = ', '.join(f'{c} = excluded.{c}' for c in cols)
+        conflict = f'DO UPDATE SET {updates}' if cols else 'DO NOTHING'
+        self._conn.execute(
+            'INSERT INTO punches VALUES (?, ?, ?, ?) '
+            f'ON CONFLICT (badge, ts_in) {conflict}',
+            (badge, punch['ts_in'], punch.get('ts_out'),
+             punch.get('duration'))
+        )
+
+    def append_punch(self, badge: str, punch: dict):
+        with self._lock, self._conn:
+            self._upsert_punch(badge, punch)
+
+    def commit_punches(self, punches: dict, statuses: dict):
+        with self._lock, self._conn:
+            for badge, punch in punches.items():
+                self._upsert_punch(badge, punch)
+            self._conn.executemany(
+                'UPDATE badges SET status = ? WHERE badge = ?',
+                [(status, badge) for badge, status in statuses.items()]
+            )
+            if self._badges is not None:
+                for badge, status in statuses.items():
+                    if badge in self._badges:
+                        self._badges[badge]['status'] = status
+
+    def punch_rows(self, start: Optional[str] = None,
+                   end: Optional[str] = None) -> list:
+        sql = ('SELECT p.badge, b.display_name, p.ts_in, p.ts_out, '
+               'p.duration FROM punches p JOIN badges b ON b.badge = p.badge '
+               'WHERE p.ts_out IS NOT NULL')
+        params = []
+        if start is not None:
+            sql += ' AND p.ts_in >= ?'
+            params.append(start)
+        if end is not None:
+            sql += ' AND p.ts_in < ?'
+            params.append(end)
+        with self._lock:
+            return self._conn.execute(sql + ' ORDER BY p.badge, p.ts_in',
+                                      params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# The binary punch format: one fixed-width little-endian record per punch,
+# sorted by ts_in. Timestamps are wall-clock seconds since 1970-01-01 (the
+# same naive local time the JSON strings hold), so the file can be read with
+# numpy.fromfile(path, dtype=punch_record_dtype) as well.
+punch_record = struct.Struct('<qqd')
+punch_record_dtype = [('ts_in', '<i8'), ('ts_out', '<i8'),
+                      ('duration', '<f8')]
+# ts_out of a punch that is still open
+_open_ts = -2 ** 63
+_epoch = datetime(1970, 1, 1)
+
+
+def ts_to_epoch(ts: str) -> int:
+    return int((datetime.strptime(ts, json_dt_fmt) - _epoch).total_seconds())
+
+
+def epoch_to_ts(seconds: int) -> str:
+    return (_epoch + timedelta(seconds=seconds)).strftime(json_dt_fmt)
+
+
+def encode_punch(punch: dict) -> tuple:
+    if 'ts_out' not in punch:
+        return (ts_to_epoch(punch['ts_in']), _open_ts, math.nan)
+    duration = punch.get('duration')
+    return (ts_to_epoch(punch['ts_in']), ts_to_epoch(punch['ts_out']),
+            math.nan if duration is None else duration)
+
+
+def decode_punch(record: tuple) -> dict:
+    ts_in, ts_out, duration = record
+    punch: dict = {'ts_in': epoch_to_ts(ts_in)}
+    if ts_out != _open_ts:
+        punch['ts_out'] = epoch_to_ts(ts_out)
+        punch['duration'] = None if math.isnan(duration) else duration
+    return punch
+
+
+def punches_to_bytes(punch_data: list) -> bytes:
+    punch_data = sorted(punch_data, key=lambda x: x['ts_in'])
+    return b''.join(punch_record.pack(*encode_punch(p)) for p in punch_data)
+
+
+def punches_from_bytes(data: bytes) -> list:
+    return [decode_punch(r) for r in punch_record.iter_unpack(data)]
+
+
+class PunchFile(Sequence):
+    """
+    A read-only, memory-mapped view of a binary punch file. Indexing decodes
+    a single record into the usual punch dict; raw() hands back the epoch
+    tuple without building any strings.
+    """
+    def __init__(self, filename: str):
+        self._file: Optional[BinaryIO] = None
+        self._map: Optional[mmap.mmap] = None
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            self._file = open(filename, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        if self._map is None:
+            return 0
+        return len(self._map) // punch_record.size
+
+    def raw(self, idx: int) -> tuple:
+        if idx < 0:
+            idx += len(self)
+        if self._map is None or not 0 <= idx < len(self):
+            raise IndexError('punch index out of range')
+        return punch_record.unpack_from(self._map, idx * punch_record.size)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return decode_punch(self.raw(idx))
+
+    def bisect(self, ts: str) -> int:
+        """Index of the first record with ts_in at or after ts, comparing
+        epochs straight out of the map."""
+        return bisect.bisect_left(range(len(self)), ts_to_epoch(ts),
+                                  key=lambda i: self.raw(i)[0])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BinaryBackend(JsonBackend):
+    """
+    badges.json as usual, but each badge's punches live in a compact
+    punch_data_{badge}.bin file of fixed-width records.
+    """
+    def _punch_file(self, badge: str) -> str:
+        return f'{self.data_dir}/punch_data_{badge}.bin'
+
+    def _punch_files(self, badge: str) -> list:
+        return [self._punch_file(badge)]
+
+    def open_punches(self, badge: str) -> PunchFile:
+        return PunchFile(self._punch_file(badge))
+
+    def read_punches(self, badge: str) -> list:
+        with self.open_punches(badge) as pf:
+            return list(pf)
+
+    def read_punches_range(self, badge: str, start: Optional[str] = None,
+                           end: Optional[str] = None) -> list:
+        with self.open_punches(badge) as pf:
+            lo = 0 if start is None else pf.bisect(start)
+            hi = len(pf) if end is None else pf.bisect(end)
+            return pf[lo:hi]
+
+    def read_raw_punches(self, badge: str) -> list:
+        # Records in the order they sit in the file
+        with self.open_punches(badge) as pf:
+            return list(pf)
+
+    def punch_badges(self) -> set:
+        return self._badges_with_files('punch_data_', '.bin')
+
+    def punch_fingerprint(self, badge: str) -> str:
+        return self._file_fingerprint(self._punch_file(badge))
+
+    def last_punch(self, badge: str):
+        with self.open_punches(badge) as pf:
+            return pf[-1] if len(pf) > 0 else None
+
+    def write_punches(self, badge: str, punch_data: list):
+        atomic_write(self._punch_file(badge), punches_to_bytes(punch_data))
+
+    def append_punch(self, badge: str, punch: dict):
+        ts_in = ts_to_epoch(punch['ts_in'])
+        with self.open_punches(badge) as pf:
+            count = len(pf)
+            last = pf[-1] if count > 0 else None
+            last_ts_in = pf.raw(-1)[0] if count > 0 else None
+        if last_ts_in is not None and ts_in < last_ts_in:
+            # Out of order (e.g. a late sync); rare enough to just rewrite.
+            punch_data = self.read_punches(badge)
+            self.write_punches(badge, apply_journal(punch_data, [punch]))
+            return
+        if last is not None and ts_in == last_ts_in:
+            # Closing the open punch: merge and overwrite it in place.
+            last.update(punch)
+            punch = last
+            count -= 1
+        filename = self._punch_file(badge)
+        with open(filename, 'r+b' if os.path.exists(filename) else 'wb') as f:
+            f.seek(count * punch_record.size)
+            f.write(punch_record.pack(*encode_punch(punch)))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def convert_json_to_binary(data_dir: str):
+    """Write a .bin punch file for every badge from its JSON punch data."""
+    copy_data(JsonBackend(data_dir), BinaryBackend(data_dir))
+
+
+def convert_binary_to_json(data_dir: str):
+    copy_data(BinaryBackend(data_dir), JsonBackend(data_dir))
+
+
+def create_backend(name: str, data_dir: str) -> StorageBackend:
+    if name == 'json':
+        return JsonBackend(data_dir)
+    if name == 'sqlite':
+        return SqliteBackend(f'{data_dir}/tritime.db')
+    if name == 'binary':
+        return BinaryBackend(data_dir)
+    raise ValueError(f'Unknown storage backend: {name}')
+
+
+def _storage_file(data_dir: str) -> str:
+    return f'{data_dir}/storage.json'
+
+
+def current_backend_name(data_dir: str) -> str:
+    """
+    The backend that holds the up to date data in data_dir. That's recorded
+    in storage.json whenever switch_backend_data moves the data; without
+    it, it's whichever backend's files are there.
+    """
+    try:
+        with open(_storage_file(data_dir), 'r') as f:
+            return json.loads(f.read())['backend']
+    except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
+        pass
+    if os.path.exists(f'{data_dir}/tritime.db'):
+        return 'sqlite'
+    if os.path.isdir(data_dir) and any(
+            f.startswith('punch_data_') and f.endswith('.bin')
+            for f in os.listdir(data_dir)):
+        return 'binary'
+    return 'json'
+
+
+def open_backend(data_dir: str) -> StorageBackend:
+    """Open an existing data directory with whichever backend wrote it."""
+    return create_backend(current_backend_name(data_dir), data_dir)
+
+
+def copy_data(src: StorageBackend, dst: StorageBackend):
+    """Copy every badge and punch from one backend into another."""
+    badges = src.get_badges()
+    dst.store_badges(badges)
+    for badge in badges.keys():
+        dst.write_punches(badge, src.read_punches(badge))
+
+
+def switch_backend_data(name: str, data_dir: str) -> Optional[str]:
+    """
+    Make the named backend the one holding data_dir's data, copying
+    everything over from the backend that has it now, so switching
+    storage_backend never starts from an empty or out of date store (in
+    either direction). Returns the backend the data came from, or None if
+    it was already there.
+    """
+    current = current_backend_name(data_dir)
+    if current == name:
+        return None
+    if name not in ('json', 'sqlite', 'binary'):
+        raise ValueError(f'Unknown storage backend: {name}')
+    src = create_backend(current, data_dir)
+    try:
+        if name == 'sqlite':
+            # Build the database off to the side and swap it in whole, so
+            # nothing from an older copy survives and a copy that gets cut
+            # short is simply redone.
+            filename = f'{data_dir}/tritime.db'
+            tmp_filename = f'{filename}.migrating'
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            dst: StorageBackend = SqliteBackend(tmp_filename)
+            copy_data(src, dst)
+            dst.close()
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+            os.replace(tmp_filename, filename)
+        else:
+            # Every badge's punches are rewritten, so whatever the target
+            # held from last time it was used is replaced.
+            dst = create_backend(name, data_dir)
+            copy_data(src, dst)
+            dst.close()
+    finally:
+        src.close()
+    # Only once the copy is complete; until then the old backend still has
+    # the data and the next switch starts over.
+    atomic_write(_storage_file(data_dir), json.dumps({'backend': name}))
+    return current
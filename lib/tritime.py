@@ -1,56 +1,397 @@
 import os
+import gzip
 import json
 import hashlib
-from datetime import datetime
+import logging
+import functools
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional
 
-json_dt_fmt = '%Y-%m-%d %H:%M:%S'
+from . import tristore
+
+json_dt_fmt = tristore.json_dt_fmt
 
 __data_dir = 'data'
 
+logger = logging.getLogger(__name__)
+
 def hash_badge_data(punches: list):
     data_str = json.dumps(punches)
     hashval = hashlib.sha256(data_str.encode()).hexdigest()
     return hashval
 
 
+_backend: tristore.StorageBackend = tristore.JsonBackend(__data_dir)
+
+
+def use_backend(name: str, data_dir: Optional[str] = None):
+    """Switch storage to the named backend ('json', 'sqlite' or 'binary'),
+    optionally pointing it at a different data directory as well. If the
+    data is in some other backend's storage, it's copied over first."""
+    global _backend, __data_dir
+    if data_dir is not None:
+        __data_dir = data_dir
+    _backend.close()
+    source = tristore.switch_backend_data(name, __data_dir)
+    if source is not None:
+        logger.info(f'copied data from {source} into {name} storage')
+    _backend = tristore.create_backend(name, __data_dir)
+    _badges_changed()
+
+
+def backend() -> tristore.StorageBackend:
+    return _backend
+
+
+def data_dir() -> str:
+    return __data_dir
+
+
 def get_badges():
-    local_filename = f'{__data_dir}/badges.json'
-    if not os.path.exists(local_filename):
-        with open(local_filename, 'w') as f:
-            f.write(json.dumps({}))
-    with open(local_filename, 'r') as f:
-        return json.loads(f.read())
+    return _backend.get_badges()
 
 
 def store_badges(data: dict):
-    with open(f'{__data_dir}/badges.json', 'w') as f:
-        f.write(json.dumps(data, indent=4, sort_keys=True))
+    _backend.store_badges(data)
+    _rebuild_alt_index(data)
+    _badges_changed()
 
 
-def read_punches(badge: str):
-    datafile = f'{__data_dir}/punch_data_{badge}.json'
-    if os.path.exists(datafile):
-        with open(datafile, 'r') as f:
-            punch_data = json.loads(f.read())
-    else:
-        punch_data = []
-    # Sort by the ts_in property
-    punch_data = sorted(punch_data, key=lambda x: x['ts_in'])
+# Bumped whenever the registry is written or the backend changes. The dict
+# get_badges() returns is updated in place, so anything built from it (like
+# the Find User index) compares generations rather than dict identity.
+_badges_generation = 0
+
+
+def _badges_changed():
+    global _badges_generation
+    _badges_generation += 1
+
+
+def badges_generation() -> int:
+    return _badges_generation
+
+
+# Users can be identified by more than one code. This maps every alternate
+# key to the "real" badge number so a lookup doesn't have to walk every
+# badge's alt_keys list.
+_alt_index: dict = {}
+_alt_index_source = None
+_alt_key_conflicts: dict = {}
+
+
+def _rebuild_alt_index(badges: dict):
+    global _alt_index, _alt_index_source, _alt_key_conflicts
+    index: dict = {}
+    conflicts: dict = {}
+    for real_badge_num, badge in badges.items():
+        for key in badge.get('alt_keys', []):
+            owner = index.get(key)
+            if owner is None:
+                index[key] = real_badge_num
+            elif owner != real_badge_num:
+                conflicts.setdefault(key, [owner]).append(real_badge_num)
+    for key in index.keys() & badges.keys():
+        if index[key] != key:
+            conflicts.setdefault(key, [index[key]]).append(key)
+    for key, owners in conflicts.items():
+        logger.warning(f'alternate key {key} is claimed by badges {owners}; '
+                       f'resolving to {owners[0]}')
+    _alt_index = index
+    _alt_key_conflicts = conflicts
+    _alt_index_source = badges
+
+
+def resolve_badge(badge_num: str) -> str:
+    """Return the real badge number for badge_num, which may be an
+    alternate key."""
+    badges = get_badges()
+    # The backend hands back a new dict whenever it re-reads its data, which
+    # is our cue that the index is stale.
+    if badges is not _alt_index_source:
+        _rebuild_alt_index(badges)
+    return _alt_index.get(badge_num, badge_num)
+
+
+def alt_key_conflicts() -> dict:
+    """Alternate keys claimed by more than one badge, as found by the last
+    index build."""
+    return dict(_alt_key_conflicts)
+
+
+def read_punches(badge: str, history: bool = False):
+    """
+    The badge's punches sorted by ts_in. Only the live (current pay period
+    and open) punches are returned unless history is True, in which case
+    punches from archived pay periods are merged in as well.
+    """
+    punch_data = _backend.read_punches(badge)
+    if history:
+        archived = archived_punches(badge)
+        if len(archived) > 0:
+            # Live punches win over archived copies of the same punch.
+            punch_data = tristore.apply_journal(archived, punch_data)
+    return punch_data
+
+
+def read_punch_map(badges, history: bool = False) -> dict:
+    """
+    badge -> read_punches(badge, history) for every badge in badges, read
+    in bulk: the backend reads them all at once (in parallel, or in one
+    query) and each archive segment is opened once.
+    """
+    punch_map = _backend.read_punch_map(badges)
+    if history:
+        for badge, archived in archived_punch_map(punch_map.keys()).items():
+            # Live punches win over archived copies of the same punch.
+            punch_map[badge] = tristore.apply_journal(archived,
+                                                      punch_map[badge])
+    return punch_map
+
+
+def _range_key(value) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return value.strftime(json_dt_fmt)
+
+
+def read_punches_range(badge: str, start=None, end=None) -> list:
+    """
+    The badge's punches with ts_in in [start, end), live and archived,
+    sorted by ts_in. start and end may be datetimes, dates or timestamp
+    strings, and either may be None to leave that side open. Only the
+    matching slice is read from the backend, and only archived periods that
+    overlap the range are looked at.
+    """
+    start, end = _range_key(start), _range_key(end)
+    punch_data = _backend.read_punches_range(badge, start, end)
+    archived = archived_punches(badge, start, end)
+    if len(archived) > 0:
+        # Live punches win over archived copies of the same punch.
+        punch_data = tristore.apply_journal(archived, punch_data)
     return punch_data
 
 
 def write_punches(badge: str, punch_data: list):
-    punch_data = sorted(punch_data, key=lambda x: x['ts_in'])
-    datafile = f'{__data_dir}/punch_data_{badge}.json'
-    with open(datafile, 'w') as f:
-        f.write(json.dumps(punch_data, indent=4, sort_keys=True))
+    _backend.write_punches(badge, punch_data)
+    _notify_punch(badge, None)
 
-def fix_badges():
+
+def write_punches_range(badge: str, start, end, punch_data: list):
+    """Replace the badge's live punches with ts_in in [start, end) by
+    punch_data, leaving everything outside the range alone."""
+    start, end = _range_key(start), _range_key(end)
+    keep = [p for p in _backend.read_punches(badge)
+            if (start is not None and p['ts_in'] < start)
+            or (end is not None and p['ts_in'] >= end)]
+    write_punches(badge, keep + punch_data)
+
+
+def append_punch(badge: str, punch: dict):
+    """Durably record a single new or updated punch without rewriting the
+    badge's history."""
+    _backend.append_punch(badge, punch)
+    _notify_punch(badge, None)
+
+
+# Callbacks that want to hear about punches as they are committed, e.g. to
+# keep running totals. Each is called as fn(badge, punch) with a punch that
+# was just opened or closed (closed ones have a ts_out), or with punch=None
+# when the badge's history changed in some other way and anything derived
+# from it should be recomputed.
+_punch_listeners: list = []
+
+
+def add_punch_listener(fn):
+    _punch_listeners.append(fn)
+
+
+def _notify_punch(badge: str, punch):
+    for fn in _punch_listeners:
+        try:
+            fn(badge, punch)
+        except Exception as e:
+            # A broken listener must never lose a punch
+            logger.error(f'punch listener failed for {badge}: {e}')
+
+
+def compact_punches(badge: str):
+    _backend.compact(badge)
+
+
+@dataclass
+class IntegrityIssue:
+    badge: str
+    kind: str
+    detail: str
+    fixed: bool = False
+
+
+@dataclass
+class IntegrityReport:
+    badges_scanned: int = 0
+    issues: list = field(default_factory=list)
+
+    def by_kind(self) -> dict:
+        kinds: dict = {}
+        for issue in self.issues:
+            kinds.setdefault(issue.kind, []).append(issue)
+        return kinds
+
+    def summary(self) -> str:
+        if len(self.issues) == 0:
+            return f'{self.badges_scanned} badges scanned, no problems found'
+        counts = ', '.join(f'{len(v)} {k}' for k, v in self.by_kind().items())
+        fixed = sum(1 for i in self.issues if i.fixed)
+        return (f'{self.badges_scanned} badges scanned: {counts} '
+                f'({fixed} fixed)')
+
+
+# Punches left open longer than this are reported as forgotten punch outs.
+stale_punch_age = timedelta(days=1)
+
+
+def _parse_times(values: list) -> np.ndarray:
+    # Unparseable or missing timestamps come back as NaT
+    return pd.to_datetime(pd.Series(values, dtype=object), format=json_dt_fmt,
+                          errors='coerce').to_numpy()
+
+
+def _scan_badge(badge: str, raw: list, status: str, now: datetime,
+                fix: bool):
+    """
+    Check one badge's stored punches. Returns the issues found, the repaired
+    punch data (or None if it doesn't need writing) and the status the badge
+    should have. The checks work on whole arrays of timestamps at once.
+    """
+    issues = []
+    records = [p if isinstance(p, dict) else {} for p in raw]
+    has_out = np.array(['ts_out' in p for p in records], dtype=bool)
+    ins = _parse_times([p.get('ts_in') for p in records])
+    outs = _parse_times([p.get('ts_out') for p in records])
+    bad = np.isnat(ins) | (has_out & np.isnat(outs))
+    for idx in np.flatnonzero(bad):
+        issues.append(IntegrityIssue(
+            badge, 'malformed', f'record {idx} is not a valid punch: '
+            f'{json.dumps(raw[idx], default=str)}'))
+    if bad.any():
+        # Leave the badge alone until a human has looked at the bad records;
+        # rewriting would mean dropping them.
+        fix = False
+        keep = ~bad
+        raw = [p for p, k in zip(raw, keep) if k]
+        has_out, ins, outs = has_out[keep], ins[keep], outs[keep]
+
+    changed = False
+    if len(ins) > 1 and (ins[1:] < ins[:-1]).any():
+        issues.append(IntegrityIssue(badge, 'unsorted',
+                                     'punches are not in ts_in order', fix))
+        order = np.argsort(ins, kind='stable')
+        raw = [raw[i] for i in order]
+        has_out, ins, outs = has_out[order], ins[order], outs[order]
+        changed = True
+
+    last = len(raw) - 1
+    for idx in np.flatnonzero(~has_out):
+        if idx < last:
+            issues.append(IntegrityIssue(
+                badge, 'open_not_last',
+                f'punch at {raw[idx]["ts_in"]} was never closed'))
+        elif np.datetime64(now) - ins[idx] > np.timedelta64(stale_punch_age):
+            issues.append(IntegrityIssue(
+                badge, 'stale_open', f'punched in since {raw[idx]["ts_in"]}'))
+
+    expected = (outs - ins) / np.timedelta64(1, 's')
+    durations = np.array([np.nan if p.get('duration') is None
+                          else p['duration'] for p in raw], dtype=float)
+    negative = has_out & (expected < 0)
+    for idx in np.flatnonzero(negative):
+        issues.append(IntegrityIssue(
+            badge, 'negative_duration',
+            f'punch at {raw[idx]["ts_in"]} ends before it starts'))
+    wrong = has_out & ~negative & (durations != expected)
+    for idx in np.flatnonzero(wrong):
+        p = raw[idx]
+        kind = ('missing_duration' if p.get('duration') is None
+                else 'wrong_duration')
+        issues.append(IntegrityIssue(
+            badge, kind, f'punch at {p["ts_in"]} has duration '
+            f'{p.get("duration")}, expected {expected[idx]}', fix))
+        if fix:
+            p['duration'] = float(expected[idx])
+            changed = True
+
+    overlap = has_out[:-1] & (ins[1:] < outs[:-1])
+    for idx in np.flatnonzero(overlap):
+        issues.append(IntegrityIssue(
+            badge, 'overlap',
+            f'punch at {raw[idx + 1]["ts_in"]} starts before the one at '
+            f'{raw[idx]["ts_in"]} ends'))
+
+    # If the last punch doesn't have a ts_out, then the badge is in
+    expected_status = 'in' if len(raw) > 0 and not has_out[-1] else 'out'
+    if bad.any():
+        expected_status = status
+    if status != expected_status:
+        issues.append(IntegrityIssue(
+            badge, 'status',
+            f'status is {status}, punches say {expected_status}', fix))
+    return issues, (raw if changed and fix else None), expected_status
+
+
+def scan_integrity(fix: bool = False,
+                   now: Optional[datetime] = None) -> IntegrityReport:
+    """
+    Check every badge's punch data for problems: unsorted records, punches
+    that were never closed, overlapping punches, missing, wrong or negative
+    durations, a status that disagrees with the punches, damaged records
+    and punch data for badges that no longer exist. With fix=True the
+    sorting, durations and statuses are repaired and damaged records are
+    dropped; everything else needs a human.
+    """
+    now = datetime.now() if now is None else now
     badges = get_badges()
-    for badge in badges.keys():
-        punch_data = read_punches(badge)
-        badges = update_badge_status(badge, badges, punch_data)
-    store_badges(badges)
+    report = IntegrityReport(badges_scanned=len(badges))
+    # Reading and parsing the files is the slow part; the backend does it
+    # in bulk (in parallel for file-based backends with many badges).
+    histories = _backend.read_punch_map(badges.keys(), raw=True)
+    statuses = {}
+    for badge, raw in histories.items():
+        issues, repaired, status = _scan_badge(
+            badge, raw, badges[badge].get('status'), now, fix)
+        report.issues.extend(issues)
+        damaged = _backend.damaged_records(badge)
+        # Rewriting what could be read drops the damaged records, unless
+        # there are malformed ones a human needs to see first.
+        drop = fix and not any(i.kind == 'malformed' for i in issues)
+        for line in damaged:
+            report.issues.append(IntegrityIssue(
+                badge, 'damaged', f'stored record {line} could not be read',
+                drop))
+        if repaired is None and drop and len(damaged) > 0:
+            repaired = _backend.read_punches(badge)
+        if repaired is not None:
+            write_punches(badge, repaired)
+        if badges[badge].get('status') != status:
+            statuses[badge] = status
+    for badge in sorted(_backend.punch_badges() - badges.keys()):
+        report.issues.append(IntegrityIssue(
+            badge, 'orphan', 'punch data exists for an unknown badge'))
+    if fix and len(statuses) > 0:
+        for badge, status in statuses.items():
+            badges[badge]['status'] = status
+        store_badges(badges)
+    return report
+
+
+def fix_badges():
+    report = scan_integrity(fix=True)
+    logger.info(report.summary())
+    return report
+
 
 def update_badge_status(badge: str, badges: list, punch_data: list, save_data=True):
     status = 'out'
@@ -62,28 +403,66 @@ def update_badge_status(badge: str, badges: list, punch_data: list, save_data=Tr
         store_badges(badges)
     return badges
 
+def punch_duration(ts_in: str, ts_out: str) -> float:
+    return (
+        datetime.strptime(ts_out, json_dt_fmt)
+        -
+        datetime.strptime(ts_in, json_dt_fmt)
+    ).total_seconds()
+
+
+def commit_punch(badge: str, punch: dict, status: str):
+    """
+    Write one new or closed punch and the badge's new status. The punch file
+    and the badge registry are each written once.
+    """
+    _backend.commit_punch(badge, punch, status)
+    _notify_punch(badge, punch)
+
+
 def punch_in(badge: str, dt: datetime):
     json_dt = dt.strftime(json_dt_fmt)
-    punch_data = read_punches(badge)
-    punch_data.append({'ts_in': json_dt})
-    write_punches(badge, punch_data)
-    # Change status
-    badges = get_badges()
-    badges = update_badge_status(badge, badges, punch_data)
-    return badges
+    commit_punch(badge, {'ts_in': json_dt}, 'in')
+    return get_badges()
 
 
 def punch_out(badge: str, dt: datetime):
     json_dt = dt.strftime(json_dt_fmt)
-    punch_data = read_punches(badge)
-    punch_data = sorted(punch_data, key=lambda x: x['ts_in'])
-    lrec = punch_data[-1]
+    # Only the last punch matters here; backends that can read it without
+    # loading the whole history do.
+    lrec = dict(_backend.last_punch(badge))
     lrec['ts_out'] = json_dt
-    write_punches(badge, punch_data)
-    badges = get_badges()
-    badges = update_badge_status(badge, badges, punch_data)
+    lrec['duration'] = punch_duration(lrec['ts_in'], json_dt)
+    commit_punch(badge, lrec, 'out')
     print(f'punch out modify status {badge}')
-    return badges
+    return get_badges()
+
+
+def punch_out_many(badges: list, dt: datetime) -> list:
+    """
+    Punch out every badge in badges at dt in one pass, writing the badge
+    registry once. Returns the badges that had an open punch to close.
+    Badges we don't know (e.g. in a message from another kiosk) are skipped.
+    """
+    json_dt = dt.strftime(json_dt_fmt)
+    known = get_badges()
+    unknown = [badge for badge in badges if badge not in known]
+    if len(unknown) > 0:
+        logger.warning(f'punch_out_many: skipping unknown badges {unknown}')
+        badges = [badge for badge in badges if badge in known]
+    closed = {}
+    for badge in badges:
+        lrec = _backend.last_punch(badge)
+        if lrec is None or 'ts_out' in lrec:
+            continue
+        lrec = dict(lrec)
+        lrec['ts_out'] = json_dt
+        lrec['duration'] = punch_duration(lrec['ts_in'], json_dt)
+        closed[badge] = lrec
+    _backend.commit_punches(closed, {badge: 'out' for badge in badges})
+    for badge, punch in closed.items():
+        _notify_punch(badge, punch)
+    return list(closed.keys())
 
 
 def create_user(badge_num: str, display_name: str, photo_url: str):
@@ -98,20 +477,295 @@ def create_user(badge_num: str, display_name: str, photo_url: str):
 
 
 def tabulate_badge(badge: str):
-    punch_data = read_punches(badge)
-    # Sort punch_data by ts_in
-    punch_data = sorted(punch_data, key=lambda x: x['ts_in'])
-    for pd in punch_data:
-        if 'ts_out' not in pd:
-            tdiff = None
-        else:
-            tdiff = (
-                datetime.strptime(pd['ts_out'], json_dt_fmt)
-                -
-                datetime.strptime(pd['ts_in'], json_dt_fmt)
-            ).total_seconds()
-        pd['duration'] = tdiff
-    write_punches(badge, punch_data)
+    # Durations are filled in at punch out, so this only has to patch up
+    # closed punches that are missing one (e.g. from older data or a sync).
+    for punch in read_punches(badge):
+        if 'ts_out' in punch and punch.get('duration') is None:
+            punch['duration'] = punch_duration(punch['ts_in'], punch['ts_out'])
+            append_punch(badge, punch)
+
+
+def retabulate(badges: Optional[list] = None) -> dict:
+    """
+    Recompute the duration of every closed punch and rewrite the punch data
+    of any badge where something changed. Returns the number of punches
+    fixed per badge. This is a repair tool; normal punching never needs it.
+    Every badge's closed punches go through one vectorized pass; punches
+    with timestamps that don't parse are left for scan_integrity to report.
+    """
+    if badges is None:
+        badges = list(get_badges().keys())
+    punch_map = read_punch_map(badges)
+    closed = [(badge, p) for badge, punch_data in punch_map.items()
+              for p in punch_data if 'ts_out' in p]
+    ins = _parse_times([p['ts_in'] for _, p in closed])
+    outs = _parse_times([p['ts_out'] for _, p in closed])
+    durations = (outs - ins) / np.timedelta64(1, 's')
+    current = pd.to_numeric(pd.Series([p.get('duration') for _, p in closed],
+                                      dtype=object),
+                            errors='coerce').to_numpy(dtype=float)
+    changed = ~np.isnan(durations) & (current != durations)
+    fixed: dict = {}
+    for idx in np.flatnonzero(changed):
+        badge, p = closed[idx]
+        p['duration'] = float(durations[idx])
+        fixed[badge] = fixed.get(badge, 0) + 1
+    for badge in fixed:
+        write_punches(badge, punch_map[badge])
+    return fixed
+
+
+# Pay periods are counted in blocks of pay_period_days from this Monday, so
+# the boundaries stay put no matter when the app was started.
+pay_period_anchor = datetime(1970, 1, 5)
+
+
+def pay_period_start(dt: datetime, period_days: int) -> datetime:
+    periods = (dt - pay_period_anchor).days // period_days
+    return pay_period_anchor + timedelta(days=periods * period_days)
+
+
+def _archive_dir(data_dir: Optional[str] = None) -> str:
+    return f'{__data_dir if data_dir is None else data_dir}/archive'
+
+
+def archive_segments(data_dir: Optional[str] = None) -> list:
+    archive_dir = _archive_dir(data_dir)
+    if not os.path.isdir(archive_dir):
+        return []
+    return sorted(f'{archive_dir}/{f}' for f in os.listdir(archive_dir)
+                  if f.startswith('period_') and f.endswith('.json.gz'))
+
+
+# Segments are never modified once written, so a cached copy never goes
+# stale; only the last few are kept so the archive doesn't end up in memory.
+@functools.lru_cache(maxsize=8)
+def _read_segment(filename: str) -> dict:
+    with gzip.open(filename, 'rt') as f:
+        return json.loads(f.read())
+
+
+@functools.lru_cache(maxsize=8)
+def _load_segment(filename: str) -> dict:
+    """
+    The segment minus any punch that an earlier segment for the same period
+    already holds. Older versions could archive a punch a second time after
+    a sync put it back in the live data.
+    """
+    segment = _read_segment(filename)
+    archive_dir, name = os.path.split(filename)
+    prefix = name[:-len('000.json.gz')]
+    earlier = sorted(f for f in os.listdir(archive_dir)
+                     if f.startswith(prefix) and f.endswith('.json.gz')
+                     and f < name)
+    if len(earlier) == 0:
+        return segment
+    seen: set = set()
+    for f in earlier:
+        for badge, ps in _read_segment(f'{archive_dir}/{f}')['punches'].items():
+            seen.update((badge, p['ts_in']) for p in ps)
+    punches = {}
+    for badge, ps in segment['punches'].items():
+        kept = [p for p in ps if (badge, p['ts_in']) not in seen]
+        if len(kept) > 0:
+            punches[badge] = kept
+    return dict(segment, punches=punches,
+                totals={b: sum(p.get('duration') or 0 for p in ps)
+                        for b, ps in punches.items()})
+
+
+# data/archive/index.json records each segment's start, end and badges so
+# readers can pick out the segments they need without opening the rest. It's
+# filled in from the segments themselves for any it doesn't cover yet.
+_archive_indexes: dict = {}
+
+
+def archive_index(data_dir: Optional[str] = None) -> dict:
+    """segment file -> {'start', 'end', 'badges'} for every segment."""
+    archive_dir = _archive_dir(data_dir)
+    files = archive_segments(data_dir)
+    cached = _archive_indexes.get(archive_dir)
+    if cached is not None and list(cached) == files:
+        return cached
+    index_file = f'{archive_dir}/index.json'
+    try:
+        with open(index_file, 'r') as f:
+            stored = json.loads(f.read())
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        stored = {}
+    index = {}
+    changed = False
+    for filename in files:
+        name = os.path.basename(filename)
+        info = stored.get(name)
+        if info is None:
+            segment = _load_segment(filename)
+            info = {'start': segment['start'], 'end': segment['end'],
+                    'badges': sorted(segment['punches'])}
+            stored[name] = info
+            changed = True
+        index[filename] = dict(info, badges=set(info['badges']))
+    if changed or len(stored) != len(files):
+        names = {os.path.basename(f) for f in files}
+        tristore.atomic_write(index_file, json.dumps(
+            {k: v for k, v in stored.items() if k in names}))
+    _archive_indexes[archive_dir] = index
+    return index
+
+
+def select_segments(start: Optional[str] = None, end: Optional[str] = None,
+                    badge: Optional[str] = None,
+                    data_dir: Optional[str] = None) -> list:
+    """The segments that can hold punches with ts_in in [start, end), and
+    only those holding the badge's punches if one is given."""
+    return [f for f, info in archive_index(data_dir).items()
+            if (start is None or info['end'] > start)
+            and (end is None or info['start'] < end)
+            and (badge is None or badge in info['badges'])]
+
+
+def archived_punches(badge: str, start: Optional[str] = None,
+                     end: Optional[str] = None) -> list:
+    """The badge's archived punches with ts_in in [start, end)."""
+    punch_data: list = []
+    for filename in select_segments(start, end, badge):
+        punches = _load_segment(filename)['punches'].get(badge, [])
+        punch_data.extend(dict(p) for p in
+                          punches[tristore.punch_slice(punches, start, end)])
+    return sorted(punch_data, key=lambda x: x['ts_in'])
+
+
+def archived_punch_map(badges=None, data_dir: Optional[str] = None) -> dict:
+    """
+    badge -> archived punches sorted by ts_in, for every badge in badges (or
+    all of them). Each segment is read once and split up by badge, which is
+    what bulk readers want instead of archived_punches per badge.
+    """
+    wanted = None if badges is None else set(badges)
+    punch_map: dict = {}
+    for filename, info in archive_index(data_dir).items():
+        if wanted is not None and wanted.isdisjoint(info['badges']):
+            continue
+        for badge, punches in _load_segment(filename)['punches'].items():
+            if wanted is None or badge in wanted:
+                punch_map.setdefault(badge, []).extend(dict(p)
+                                                       for p in punches)
+    for punches in punch_map.values():
+        punches.sort(key=lambda x: x['ts_in'])
+    return punch_map
+
+
+def archived_segment(filename: str) -> dict:
+    """One archive segment: its start, end, totals and punches by badge."""
+    return _load_segment(filename)
+
+
+def archived_totals() -> list:
+    """(start, end, {badge: seconds}) for every archived pay period segment."""
+    return [(seg['start'], seg['end'], seg['totals'])
+            for seg in map(_load_segment, archive_segments())
+            if len(seg['punches']) > 0]
+
+
+def archive_closed_periods(period_days: int,
+                           now: Optional[datetime] = None) -> list:
+    """
+    Move closed punches from finished pay periods out of the live punch data
+    and into one compressed, read-only segment per period under
+    data/archive, along with each badge's total seconds for the period.
+    Returns the segment files written.
+    """
+    now = datetime.now() if now is None else now
+    cutoff = pay_period_start(now, period_days).strftime(json_dt_fmt)
+    periods: dict = {}
+    remaining = {}
+    for badge in get_badges().keys():
+        punch_data = read_punches(badge)
+        keep = [p for p in punch_data
+                if 'ts_out' not in p or p['ts_in'] >= cutoff]
+        if len(keep) == len(punch_data):
+            continue
+        for p in punch_data:
+            if 'ts_out' in p and p['ts_in'] < cutoff:
+                start = pay_period_start(datetime.fromisoformat(p['ts_in']),
+                                         period_days)
+                periods.setdefault(start, {}).setdefault(badge, []).append(p)
+        remaining[badge] = keep
+
+    # Segments go out before the live data is trimmed; a crash in between
+    # leaves a punch in both places, which archived reads de-duplicate.
+    os.makedirs(_archive_dir(), exist_ok=True)
+    existing = archive_segments()
+    written = []
+    for start, punches in sorted(periods.items()):
+        seg_start = start.strftime(json_dt_fmt)
+        seg_end = (start + timedelta(days=period_days)).strftime(json_dt_fmt)
+        # A punch can come back into the live data after it was archived
+        # (e.g. a full-history sync); it's already archived, so just let it
+        # go from the live data.
+        archived: set = set()
+        for f in select_segments(seg_start, seg_end):
+            for badge, ps in _load_segment(f)['punches'].items():
+                archived.update((badge, p['ts_in']) for p in ps)
+        punches = {b: [p for p in ps if (b, p['ts_in']) not in archived]
+                   for b, ps in punches.items()}
+        punches = {b: ps for b, ps in punches.items() if len(ps) > 0}
+        if len(punches) == 0:
+            continue
+        prefix = f'{_archive_dir()}/period_{start:%Y%m%d}_'
+        seq = sum(1 for f in existing if f.startswith(prefix))
+        filename = f'{prefix}{seq:03d}.json.gz'
+        segment = {
+            'start': seg_start,
+            'end': seg_end,
+            'totals': {b: sum(p.get('duration') or 0 for p in ps)
+                       for b, ps in punches.items()},
+            'punches': punches,
+        }
+        tristore.atomic_write(filename,
+                              gzip.compress(json.dumps(segment).encode()))
+        written.append(filename)
+    for badge, keep in remaining.items():
+        write_punches(badge, keep)
+    return written
+
+
+def punch_rows(start: Optional[str] = None, end: Optional[str] = None,
+               data_dir: Optional[str] = None) -> list:
+    """
+    Every closed punch, live and archived, as (badge, display_name, ts_in,
+    ts_out, duration) tuples, optionally limited to ts_in in [start, end).
+    With data_dir, the rows come from the data directory of some other
+    system (e.g. a copy of another kiosk's) rather than ours.
+    """
+    if data_dir is None:
+        rows = _backend.punch_rows(start, end)
+        badges = get_badges()
+    else:
+        store = tristore.open_backend(data_dir)
+        try:
+            rows = store.punch_rows(start, end)
+            badges = store.get_badges()
+        finally:
+            store.close()
+    seen = {(r[0], r[2]) for r in rows}
+    # Only segments that can overlap the requested range are opened
+    for filename in select_segments(start, end, data_dir=data_dir):
+        segment = _load_segment(filename)
+        for badge, punches in segment['punches'].items():
+            if badge not in badges:
+                continue
+            for p in punches:
+                if (badge, p['ts_in']) in seen:
+                    continue
+                if start is not None and p['ts_in'] < start:
+                    continue
+                if end is not None and p['ts_in'] >= end:
+                    continue
+                seen.add((badge, p['ts_in']))
+                rows.append((badge, badges[badge]['display_name'],
+                             p['ts_in'], p['ts_out'], p.get('duration')))
+    return rows
 
 
 # This will NOT run when imported!
@@ -7,19 +7,23 @@ import wx
 import sys
 import wx.adv
 import json
-import time
-import requests
+import queue
+import bisect
+import multiprocessing
 import wx.grid as wxgrid
 import lib.tritime as libtt
 import lib.trireport as libtr
 import lib.libazure as libaz
+import lib.photos as libphotos
+import lib.trisearch as libsearch
 
 from version import VERSION
 from lib.libazure import TriTimeEvent
 from functools import wraps
 from io import BytesIO
-from threading import Thread, Timer
-from datetime import datetime
+from threading import Lock, Thread, Timer
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 # Create a custom event type for debounced events
 wxEVT_DEBOUNCED_TEXT = wx.NewEventType()
@@ -35,6 +39,10 @@ def default_app_settings() -> dict[str, any]:
         'show_active_badges': True,
         'auto_out_time': '20:30',
         'pay_period_days': 14,
+        'storage_backend': 'json',
+        # system_id -> data directory of every kiosk to include in exports;
+        # empty means just this one.
+        'report_sites': {},
     }
 
 
@@ -97,27 +105,17 @@ def is_json(myjson):
     return True
 
 
-# If we have a URL (http:// or https://), download the image from the URL
-def download_image(url, width=64, height=64):
-    # This method is a hot mess and needs to be cleaned up.
-    image = wx.Image()
-    image.LoadFile('unknown_badge.png', wx.BITMAP_TYPE_PNG)
-    valid_image = False
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            # Convert the image data into a wx.Bitmap
-            image_data = BytesIO(response.content)
-            image = wx.Image(image_data)
-            image = image.Scale(width, height, wx.IMAGE_QUALITY_HIGH)
-            valid_image = True
-        else:
-            image.LoadFile('unknown_badge.png', wx.BITMAP_TYPE_PNG)
-            valid_image = False
-    except:  # noqa
-        image.LoadFile('unknown_badge.png', wx.BITMAP_TYPE_PNG)
-        valid_image = False
-    return image, valid_image
+# Turn a downloaded photo into the 64x64 PNG we keep in cached_photos. This
+# runs on the downloader's worker threads; wx.Image (unlike wx.Bitmap) is
+# fine to use off the UI thread.
+def decode_photo(data, width=64, height=64):
+    image = wx.Image(BytesIO(data))
+    if not image.IsOk():
+        raise ValueError('not an image')
+    image = image.Scale(width, height, wx.IMAGE_QUALITY_HIGH)
+    out = BytesIO()
+    image.SaveFile(out, wx.BITMAP_TYPE_PNG)
+    return out.getvalue()
 
 class DebouncedTextEvent(wx.PyCommandEvent):
     """Custom event for debounced text changes"""
@@ -162,6 +160,323 @@ class DebouncedTextCtrl(wx.TextCtrl):
         wx.PostEvent(self, evt)
 
 
+class PunchGridTable(wxgrid.GridTableBase):
+    """
+    Virtual table behind the Check Time grid. It holds the punch list as-is
+    and only formats a cell when the grid asks for it, newest punch first.
+    """
+    col_labels = ['Time In', 'Time Out', 'Hours']
+
+    def __init__(self):
+        super().__init__()
+        self.punch_data = []
+
+    def set_punches(self, grid, punch_data):
+        old_rows = len(self.punch_data)
+        self.punch_data = punch_data
+        new_rows = len(punch_data)
+        grid.BeginBatch()
+        if new_rows < old_rows:
+            msg = wxgrid.GridTableMessage(
+                self, wxgrid.GRIDTABLE_NOTIFY_ROWS_DELETED,
+                new_rows, old_rows - new_rows)
+            grid.ProcessTableMessage(msg)
+        elif new_rows > old_rows:
+            msg = wxgrid.GridTableMessage(
+                self, wxgrid.GRIDTABLE_NOTIFY_ROWS_APPENDED,
+                new_rows - old_rows)
+            grid.ProcessTableMessage(msg)
+        grid.EndBatch()
+        grid.ForceRefresh()
+
+    def GetNumberRows(self):
+        return len(self.punch_data)
+
+    def GetNumberCols(self):
+        return len(self.col_labels)
+
+    def GetColLabelValue(self, col):
+        return self.col_labels[col]
+
+    def IsEmptyCell(self, row, col):
+        return False
+
+    def GetValue(self, row, col):
+        row_data = self.punch_data[len(self.punch_data) - 1 - row]
+        if col == 0:
+            return str(row_data.get('ts_in', 'N/A - Error'))
+        if col == 1:
+            return str(row_data.get('ts_out', 'N/A - Error'))
+        if 'duration' not in row_data:
+            return ''
+        d = row_data['duration']
+        return str(round((d or 0) / 3600, 2))
+
+    def SetValue(self, row, col, value):
+        return
+
+
+class BitmapCache:
+    """
+    Ready-to-draw badge photos, least recently used dropped first once there
+    are more than maxsize. Keyed by badge and size, where a size of None is
+    the image as stored. Badges without a cached photo share the
+    placeholder, which is only decoded once per size.
+    """
+    def __init__(self, maxsize=256, placeholder='unknown_badge.png'):
+        self.maxsize = maxsize
+        self.placeholder = placeholder
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bitmaps = OrderedDict()
+        self._placeholders = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def photo_file(badge_num):
+        return f'cached_photos/{badge_num}.png'
+
+    def _load(self, filename, size):
+        img = wx.Image()
+        img.LoadFile(filename, wx.BITMAP_TYPE_PNG)
+        if size is not None and img.GetSize() != size:
+            img = img.Scale(size[0], size[1], wx.IMAGE_QUALITY_HIGH)
+        return wx.Bitmap(img)
+
+    def get(self, badge_num, size=None):
+        key = (badge_num, size)
+        with self._lock:
+            bmp = self._bitmaps.get(key)
+            if bmp is not None:
+                self._bitmaps.move_to_end(key)
+                self.hits += 1
+                return bmp
+            self.misses += 1
+        filename = self.photo_file(badge_num)
+        if os.path.exists(filename):
+            bmp = self._load(filename, size)
+        else:
+            bmp = self.get_placeholder(size)
+        with self._lock:
+            self._bitmaps[key] = bmp
+            while len(self._bitmaps) > self.maxsize:
+                self._bitmaps.popitem(last=False)
+                self.evictions += 1
+        return bmp
+
+    def get_placeholder(self, size=None):
+        bmp = self._placeholders.get(size)
+        if bmp is None:
+            bmp = self._load(self.placeholder, size)
+            self._placeholders[size] = bmp
+        return bmp
+
+    def invalidate(self, badge_num=None):
+        """Forget badge_num's photo at every size, or everything if no
+        badge is given."""
+        with self._lock:
+            if badge_num is None:
+                self._bitmaps.clear()
+                return
+            for key in [k for k in self._bitmaps if k[0] == badge_num]:
+                del self._bitmaps[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._bitmaps),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            }
+
+
+photo_cache = BitmapCache()
+
+
+class BadgeCardPool(wx.Panel):
+    """
+    A scrolling grid of badge cards that only ever has rows x cols cards.
+    Scrolling or a new set of results just points the existing cards at
+    different badges (new photo and label), so the cost doesn't grow with
+    the number of results. on_pick(badge_num) is called when one is tapped.
+    """
+    def __init__(self, parent, on_pick, rows=4, cols=5):
+        super().__init__(parent)
+        self.on_pick = on_pick
+        self.rows = rows
+        self.cols = cols
+        self.results = []
+        self.names = {}
+        self.top_row = 0
+        self.scrollbar = wx.ScrollBar(self, style=wx.SB_VERTICAL)
+        self.scrollbar.Bind(wx.EVT_SCROLL, self.on_scroll)
+        self.Bind(wx.EVT_MOUSEWHEEL, self.on_wheel)
+        grid = wx.GridSizer(rows, cols, 10, 10)
+        self.cards = []
+        for slot in range(rows * cols):
+            bmp = wx.StaticBitmap(self, -1, photo_cache.get_placeholder())
+            btn = wx.Button(self, label='', size=(140, 80))
+            btn.Bind(wx.EVT_BUTTON, lambda event, slot=slot: self.pick(slot))
+            bmp.Bind(wx.EVT_MOUSEWHEEL, self.on_wheel)
+            btn.Bind(wx.EVT_MOUSEWHEEL, self.on_wheel)
+            vbox = wx.BoxSizer(wx.VERTICAL)
+            vbox.Add(bmp, flag=wx.CENTER)
+            vbox.AddSpacer(10)
+            vbox.Add(btn, flag=wx.CENTER)
+            grid.Add(vbox, 0, wx.ALL, border=10)
+            self.cards.append((bmp, btn))
+        hbox = wx.BoxSizer(wx.HORIZONTAL)
+        hbox.Add(grid, 1, wx.EXPAND)
+        hbox.Add(self.scrollbar, 0, wx.EXPAND)
+        self.SetSizer(hbox)
+
+    def set_results(self, badge_nums, badges):
+        self.results = badge_nums
+        self.names = {num: badges[num]['display_name'] for num in badge_nums}
+        self.top_row = 0
+        total_rows = -(-len(badge_nums) // self.cols)
+        self.scrollbar.SetScrollbar(0, self.rows, max(total_rows, 1),
+                                    self.rows)
+        self.render()
+
+    def render(self):
+        self.Freeze()
+        first = self.top_row * self.cols
+        for slot, (bmp, btn) in enumerate(self.cards):
+            idx = first + slot
+            show = idx < len(self.results)
+            if show:
+                badge_num = self.results[idx]
+                bmp.SetBitmap(photo_cache.get(badge_num))
+                btn.SetLabel(self.names[badge_num])
+            bmp.Show(show)
+            btn.Show(show)
+        self.Thaw()
+
+    def scroll_to(self, row):
+        total_rows = -(-len(self.results) // self.cols)
+        row = max(0, min(row, total_rows - self.rows))
+        if row != self.top_row:
+            self.top_row = row
+            self.scrollbar.SetThumbPosition(row)
+            self.render()
+
+    def on_scroll(self, event):
+        self.scroll_to(event.GetPosition())
+
+    def on_wheel(self, event):
+        rows = event.GetWheelRotation() // max(event.GetWheelDelta(), 1)
+        self.scroll_to(self.top_row - rows)
+
+    def pick(self, slot):
+        idx = self.top_row * self.cols + slot
+        if idx < len(self.results):
+            self.on_pick(self.results[idx])
+
+
+# Seconds a cancelled export gets to stop by itself before it's killed
+export_cancel_timeout = 5
+
+
+class ExportProgressDialog(wx.Dialog):
+    """
+    Modeless progress window for an export running in a worker process.
+    Punching carries on as normal while it's up.
+    """
+    def __init__(self, parent, filepath):
+        super().__init__(parent, title='Exporting...')
+        self.filepath = filepath
+        self.cancelled = False
+        # Spawned rather than forked: a fork of a GTK app with the Azure
+        # threads running could inherit locks they hold and hang.
+        context = multiprocessing.get_context('spawn')
+        self.messages = context.Queue()
+        self.cancel_event = context.Event()
+        # Not a daemon, so the export can start processes of its own to read
+        # punch data in parallel; cancel() and the main window's shutdown
+        # make sure it doesn't outlive us.
+        self.process = context.Process(
+            target=libtr.export_worker,
+            args=(filepath, _app_settings.get('storage_backend', 'json'),
+                  self.messages, _app_settings.get('report_sites'),
+                  self.cancel_event)
+        )
+        self.status = wx.StaticText(self, label='Starting export...')
+        self.gauge = wx.Gauge(self, range=100, size=(300, -1))
+        cancel_btn = wx.Button(self, label='Cancel', size=(80, 80))
+        cancel_btn.Bind(wx.EVT_BUTTON, self.cancel)
+        self.Bind(wx.EVT_CLOSE, self.cancel)
+        vbox = wx.BoxSizer(wx.VERTICAL)
+        vbox.AddSpacer(20)
+        vbox.Add(self.status)
+        vbox.AddSpacer(5)
+        vbox.Add(self.gauge)
+        vbox.AddSpacer(20)
+        vbox.Add(cancel_btn)
+        vbox.AddSpacer(20)
+        self.SetSizerAndFit(vbox)
+        self.process.start()
+        self.watcher = Thread(target=self.watch, daemon=True)
+        self.watcher.start()
+
+    # Runs on its own thread; everything that touches widgets goes through
+    # wx.CallAfter.
+    def watch(self):
+        while not self.cancelled:
+            try:
+                msg = self.messages.get(timeout=0.2)
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+                # The worker may have exited just after putting its last
+                # message, so check for that before calling it a failure.
+                try:
+                    msg = self.messages.get_nowait()
+                except queue.Empty:
+                    wx.CallAfter(self.finish, 'error',
+                                 'The export stopped unexpectedly')
+                    return
+            if msg[0] == 'progress':
+                wx.CallAfter(self.show_progress, *msg[1:])
+            else:
+                wx.CallAfter(self.finish, *msg)
+                return
+
+    def show_progress(self, done, total, message):
+        if self.cancelled:
+            return
+        self.gauge.SetRange(max(total, 1))
+        self.gauge.SetValue(done)
+        self.status.SetLabel(f'{message} ({done} of {total})')
+
+    def finish(self, result, detail):
+        if self.cancelled:
+            return
+        self.process.join()
+        self.GetParent().export_finished(result, detail)
+        self.Destroy()
+
+    def cancel(self, event):
+        self.cancelled = True
+        # Ask the worker to stop so it can shut down its reader processes;
+        # only kill it if it doesn't get to a progress step soon.
+        self.cancel_event.set()
+        self.process.join(export_cancel_timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        partial = libtr.partial_export_file(self.filepath)
+        if os.path.exists(partial):
+            os.remove(partial)
+        self.GetParent().export_finished('cancelled', self.filepath)
+        self.Destroy()
+
+
 class MainWindow(wx.Frame):
 
     def return_focus(func):
@@ -190,6 +505,11 @@ class MainWindow(wx.Frame):
         self.badge_clear_btn.Bind(wx.EVT_BUTTON, self.clear_badge_input)
         self.export_btn = wx.Button(self, label='Export Data')
         self.export_btn.Bind(wx.EVT_BUTTON, self.export_data)
+        self.export_dlg = None
+        self.photo_thread = None
+        self.find_user_index = None
+        self.photo_downloader = libphotos.PhotoDownloader(
+            photo_dir='cached_photos', decode=decode_photo)
         self.greeting_label = wx.StaticText(self, -1, 'Welcome to TriTime')
         self.clock_display = wx.StaticText(self, -1, 'HH:mm:ss AP')
         tc = wx.Font(28, wx.FONTFAMILY_TELETYPE,
@@ -234,6 +554,10 @@ class MainWindow(wx.Frame):
         self.badge_scroller.SetScrollRate(10, 10)
         self.badge_scroller.SetMinSize((600, 300))
         self.badge_scroller.SetSizer(self.active_badge_sizer)
+        # badge -> (display_name, card sizer) for every card on the grid, and
+        # the sorted (display_name, badge) keys that give their order
+        self.active_badge_cards = {}
+        self.active_badge_keys = []
 
         spacer_size = 20
         # This lets us put a space to the left of everything by putting our
@@ -305,9 +629,11 @@ class MainWindow(wx.Frame):
         self.Update()
 
         self.Bind(wx.EVT_CLOSE, self.on_app_shutdown)
-        self.clock_thread_run = True
-        self.clock_thread = Thread(target=self.update_clock)
-        self.clock_thread.start()
+        # The clock ticks once a second, just after the second changes
+        self.clock_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.update_clock, self.clock_timer)
+        self.schedule_auto_out()
+        self.update_clock(None)
 
         self.update_active_badges()
         self.badge_num_input.SetFocus()
@@ -321,10 +647,12 @@ class MainWindow(wx.Frame):
         self.shutdown()
 
     def shutdown(self):
+        if self.export_dlg is not None:
+            self.export_dlg.cancel(None)
         if azure_enabled():
             libaz.stop()
-        self.clock_thread_run = False
-        self.clock_thread.join()
+        libtr.rollups.save()
+        self.clock_timer.Stop()
         self.Destroy()
 
     @return_focus
@@ -346,49 +674,112 @@ class MainWindow(wx.Frame):
         )
 
         # Show the dialog and get user input
+        filepath = None
         if dialog.ShowModal() == wx.ID_OK:
             # Get the chosen filename and path
             filepath = dialog.GetPath()
-            wx.MessageBox(f"File chosen: {filepath}", "Export Complete")
         dialog.Destroy()
-        libtr.export_to_excel(filepath)
-
-    def update_clock(self):
-        while self.clock_thread_run:
-            time.sleep(0.1)
-            current_time = time.strftime("%I:%M:%S %p")
-            curr_hour = datetime.now().hour
-            curr_mins = datetime.now().minute
-            # Use wx.CallAfter to update the StaticText in the main thread
-            wx.CallAfter(self.clock_display.SetLabel, current_time)
-            notused = """
-            auto_out_time = _app_settings.get('auto_out_time', None)
-            if auto_out_time is not None:
-                out_hour, out_min = map(int, auto_out_time.split(':'))
-                if out_hour > curr_hour and out_min > curr_mins:
-                    self.punch_all_out(None)
-            """
-
-    # Remove all of the active badges from the grid; this was easier than
-    # trying to remove the one-by-one.
+        if filepath is None:
+            return
+        if self.export_dlg is not None:
+            wx.MessageBox('An export is already running.', 'Error',
+                          wx.OK | wx.ICON_ERROR)
+            return
+        # The export runs in another process; we just watch its progress.
+        self.export_dlg = ExportProgressDialog(self, filepath)
+        self.export_dlg.Show()
+
+    def export_finished(self, result, detail):
+        self.export_dlg = None
+        if result == 'done':
+            self.greeting_label.SetLabel(f'Export complete: {detail}')
+        elif result == 'error':
+            wx.MessageBox(f'Export failed: {detail}', 'Error',
+                          wx.OK | wx.ICON_ERROR)
+        self.badge_num_input.SetFocus()
+
+    def update_clock(self, event):
+        now = datetime.now()
+        current_time = now.strftime('%I:%M:%S %p')
+        if current_time != self.clock_display.GetLabel():
+            self.clock_display.SetLabel(current_time)
+        if self.next_auto_out is not None and now >= self.next_auto_out:
+            self.punch_all_out(None)
+            self.schedule_auto_out(now)
+        # Wake again just past the next second boundary
+        ms = 1000 - now.microsecond // 1000 + 5
+        self.clock_timer.StartOnce(ms)
+
+    # Work out when the auto_out_time punch-out should next happen: the next
+    # time the clock reaches it, strictly after now. Starting up after it has
+    # passed for the day waits until tomorrow.
+    def schedule_auto_out(self, now=None):
+        now = datetime.now() if now is None else now
+        auto_out_time = _app_settings.get('auto_out_time', None)
+        if auto_out_time is None:
+            self.next_auto_out = None
+            return
+        out_hour, out_min = map(int, auto_out_time.split(':'))
+        next_out = now.replace(hour=out_hour, minute=out_min,
+                               second=0, microsecond=0)
+        if next_out <= now:
+            next_out += timedelta(days=1)
+        self.next_auto_out = next_out
+
+    # Remove all of the active badges from the grid
     def clear_active_badges(self):
         self.active_badge_sizer.Clear(True)
-        self.Layout()
-        self.Update()
+        self.active_badge_cards = {}
+        self.active_badge_keys = []
+        self.layout_active_badges()
 
-    # Draw every punched in badge on the grid with a button to punch them out
+    # Bring the grid in line with who is punched in. The grid is kept as a
+    # model of badge -> card, so only the cards that changed are created or
+    # destroyed, and there's one layout pass at the end.
     def update_active_badges(self):
-        self.Freeze()
-        self.clear_active_badges()
         if _app_settings['show_active_badges'] is False:
+            if len(self.active_badge_cards) > 0:
+                self.clear_active_badges()
             return
-        badges = libtt.get_badges()
-        # Sort by the display name
-        badges = dict(sorted(badges.items(), key=lambda x: x[1]['display_name']))
-        for bnum, badge in badges.items():
-            if badge['status'] == 'in':
-                self.add_badge_to_grid(bnum)
+        wanted = {bnum: badge['display_name']
+                  for bnum, badge in libtt.get_badges().items()
+                  if badge['status'] == 'in'}
+        # A renamed badge is moved by taking it out and putting it back
+        remove = [bnum for bnum, card in self.active_badge_cards.items()
+                  if wanted.get(bnum) != card[0]]
+        add = [bnum for bnum in wanted if bnum not in self.active_badge_cards
+               or bnum in remove]
+        if len(remove) == 0 and len(add) == 0:
+            return
+        self.Freeze()
+        for bnum in remove:
+            self._remove_badge_card(bnum)
+        for bnum in add:
+            self._insert_badge_card(bnum, wanted[bnum])
         self.Thaw()
+        self.layout_active_badges()
+
+    def layout_active_badges(self):
+        self.badge_scroller.FitInside()
+        self.Layout()
+        self.Update()
+
+    def _insert_badge_card(self, badge_num, display_name):
+        # Cards are kept sorted by display name
+        key = (display_name, badge_num)
+        idx = bisect.bisect_left(self.active_badge_keys, key)
+        vbox = self.create_badge_card(badge_num,
+                                      self.badge_scroller,
+                                      self.punch_out)
+        self.active_badge_sizer.Insert(idx, vbox, 0, wx.ALL, border=10)
+        self.active_badge_keys.insert(idx, key)
+        self.active_badge_cards[badge_num] = (display_name, vbox)
+
+    def _remove_badge_card(self, badge_num):
+        display_name, vbox = self.active_badge_cards.pop(badge_num)
+        self.active_badge_keys.remove((display_name, badge_num))
+        vbox.Clear(True)
+        self.active_badge_sizer.Remove(vbox)
 
     def create_badge_card(self, badge_num, parent=None, bind_method=None):
         parent = self if parent is None else parent
@@ -396,18 +787,9 @@ class MainWindow(wx.Frame):
         badges = libtt.get_badges()
         badge = badges[badge_num]
         badge_name = badge['display_name']
-        cached_image_filename = f'cached_photos/{badge_num}.png'
-        # If we already have a file downloaded (cached) for this badge just
-        # use that.
-        if os.path.exists(cached_image_filename):
-            img = wx.Image()
-            img.LoadFile(cached_image_filename, wx.BITMAP_TYPE_PNG)
-        # Otherwise we can download the image from the URL
-        else:
-            img = wx.Image()
-            img.LoadFile('unknown_badge.png', wx.BITMAP_TYPE_PNG)
-        img = wx.Bitmap(img)
-        bmp = wx.StaticBitmap(parent, -1, img)
+        # The downloaded photo if we have one, otherwise the placeholder,
+        # decoded once and then served from memory.
+        bmp = wx.StaticBitmap(parent, -1, photo_cache.get(badge_num))
         vbox = wx.BoxSizer(wx.VERTICAL)
         btn = wx.Button(parent, label=badge_name, size=(-1, 80))
         btn.Bind(wx.EVT_BUTTON, lambda event: bind_method(event, badge_num))
@@ -418,12 +800,18 @@ class MainWindow(wx.Frame):
 
     # Draws an individual badge on the grid with a button to punch them out
     def add_badge_to_grid(self, badge_num):
-        vbox = self.create_badge_card(badge_num,
-                                        self.badge_scroller,
-                                        self.punch_out)
-        self.active_badge_sizer.Add(vbox, 0, wx.ALL, border=10)
-        self.Layout()
-        self.Update()
+        if (_app_settings['show_active_badges'] is False
+                or badge_num in self.active_badge_cards):
+            return
+        badge = libtt.get_badges()[badge_num]
+        self._insert_badge_card(badge_num, badge['display_name'])
+        self.layout_active_badges()
+
+    def remove_badge_from_grid(self, badge_num):
+        if badge_num not in self.active_badge_cards:
+            return
+        self._remove_badge_card(badge_num)
+        self.layout_active_badges()
 
     # Reset the badge number input and set the focus back to it
     def clear_input(self):
@@ -432,16 +820,6 @@ class MainWindow(wx.Frame):
         self.out_btn.Disable()
         self.badge_num_input.SetFocus()
 
-    # Users can be identified by more than one code; this method will look up
-    # the "real" badge number if an alternate is entered.
-    def lookup_alt(self, badges, badge_num):
-        for real_badge_num, badge in badges.items():
-            if 'alt_keys' not in badge:
-                continue
-            if badge_num in badge['alt_keys']:
-                return real_badge_num
-        return badge_num
-
     @return_focus
     def clear_badge_input(self, event):
         self.badge_num_input.SetValue('')
@@ -490,9 +868,24 @@ class MainWindow(wx.Frame):
             libtt.fix_badges()
             return
 
+        if badge_num == 'retabulate':
+            libtt.retabulate()
+            return
+
+        if badge_num == 'photocache':
+            print(photo_cache.stats())
+            return
+
         if badge_num == 'publishdata':
             if azure_enabled():
-                libaz.publish_data()
+                # Older periods are archived and don't change, so only the
+                # current one needs to go out. Reading every badge's punches
+                # takes a while, so it's done off the UI thread.
+                start = libtt.pay_period_start(datetime.now(),
+                                               libtr.rollups.period_days)
+                Thread(target=libaz.publish_data, args=(start,),
+                       daemon=True).start()
+            return
 
         if badge_num == 'debug':
             import wx.lib.inspection
@@ -522,7 +915,7 @@ class MainWindow(wx.Frame):
         if badge is None:
             badge = self.badge_num_input.GetValue()
         badge = badge.strip()
-        badge = self.lookup_alt(libtt.get_badges(), badge)
+        badge = libtt.resolve_badge(badge)
         return badge
 
     # Buttons to punch in will call this method; we pass off all the data
@@ -531,7 +924,7 @@ class MainWindow(wx.Frame):
     def punch_in(self, event):
         badge = self.get_entered_badge()
         dt = datetime.now()
-        badges = libtt.punch_in(badge, dt)
+        libtt.punch_in(badge, dt)
         if azure_enabled():
             msg = TriTimeEvent(
                 system_id=system_id(),
@@ -541,7 +934,6 @@ class MainWindow(wx.Frame):
                 details={}
             )
             libaz.message_queue.put(msg)
-        libtt.store_badges(badges)
         self.add_badge_to_grid(badge)
         self.clear_input()
 
@@ -550,13 +942,9 @@ class MainWindow(wx.Frame):
     @return_focus
     def punch_out(self, event, badge_num=None):
         badge_num = self.get_entered_badge(badge_num) if badge_num is None else badge_num
-        bni = self.badge_num_input
-        badge = bni.GetValue() if badge_num is None else badge_num
-        badge = self.lookup_alt(libtt.get_badges(), badge)
+        badge = libtt.resolve_badge(badge_num)
         dt = datetime.now()
-        badges = libtt.punch_out(badge, dt)
-        libtt.store_badges(badges)
-        libtt.tabulate_badge(badge)
+        libtt.punch_out(badge, dt)
         if azure_enabled():
             msg = TriTimeEvent(
                 system_id=system_id(),
@@ -566,72 +954,44 @@ class MainWindow(wx.Frame):
                 details={}
             )
             libaz.message_queue.put(msg)
-        self.update_active_badges()
+        self.remove_badge_from_grid(badge)
         self.clear_input()
 
     # Adds up all of the time a badge has been punched in.
     @return_focus
     def check_time_dialog(self, event):
-        # Create a dialog that has inputs for a badge number, display name,
-        # and photo URL.  When the dialog is submitted, add the user to the
-        # database and update the active badges grid.
-        def badge_change(event):
-            badge = event.GetString().strip()
-            badge = self.lookup_alt(libtt.get_badges(), badge)
-            # Create a grid
-            punch_data = libtt.read_punches(badge)
-            punch_data.reverse()
-            curr_rows = check_time_grid.GetNumberRows()
-            new_rows = len(punch_data) + 1
-            if new_rows > curr_rows:
-                check_time_grid.AppendRows(new_rows-curr_rows)
-            elif new_rows < curr_rows:
-                check_time_grid.DeleteRows(new_rows, curr_rows-new_rows)
-
-            # Populate the grid with data
-            total_duration = 0
-            for row_index, row_data in enumerate(punch_data):
-                instr = 'N/A - Error'
-                outstr = 'N/A - Error'
-                duration = ''
-                if 'ts_in' in row_data:
-                    instr = str(row_data['ts_in'])
-                if 'ts_out' in row_data:
-                    outstr = str(row_data['ts_out'])
-                if 'duration' in row_data:
-                    d = row_data['duration']
-                    if d is None:
-                        d = 0
-                    total_duration += d
-                    duration = str(round(d/3600, 2))
-                check_time_grid.SetCellValue(row_index+1, 0, instr)
-                check_time_grid.SetCellValue(row_index+1, 1, outstr)
-                check_time_grid.SetCellValue(row_index+1, 2, duration)
-
-            check_time_grid.SetCellValue(0, 2,
-                                        str(round(total_duration/3600, 2)))
-
-            check_time_grid.Show()
-            check_time_grid.Layout()
-            check_time_grid.Update()
-            check_time_grid.AutoSize()
-            checktime_dlg.SetSizerAndFit(vbox)
-            checktime_dlg.Layout()
-            checktime_dlg.Update()
-
+        # Create a dialog with a badge input, a summary of their hours and a
+        # grid of this pay period's punches. The totals come from the running
+        # rollups and the grid only formats the rows that are on screen.
+        def show_badge(badge):
+            badge = libtt.resolve_badge(badge.strip())
+            period_start = libtt.pay_period_start(datetime.now(),
+                                                  libtr.rollups.period_days)
+            punch_data = libtt.read_punches_range(badge, period_start)
+            punch_table.set_punches(check_time_grid, punch_data)
+            total = libtr.rollups.hours(badge)
+            period = libtr.rollups.period_hours(badge)
+            summary_label.SetLabel(
+                f'Total: {round(total, 2)} hours    '
+                f'This pay period: {round(period, 2)} hours'
+            )
 
         checktime_dlg = wx.Dialog(self, title='Checking Time...')
         check_time_grid = wxgrid.Grid(checktime_dlg)
-        check_time_grid.CreateGrid(0, 3)
-        # Set the column labels
-        check_time_grid.SetColLabelValue(0, 'Time In')
-        check_time_grid.SetColLabelValue(1, 'Time Out')
-        check_time_grid.SetColLabelValue(2, 'Hours')
+        punch_table = PunchGridTable()
+        check_time_grid.SetTable(punch_table, takeOwnership=True)
         check_time_grid.HideRowLabels()
+        check_time_grid.EnableEditing(False)
+        for col, width in enumerate([180, 180, 80]):
+            check_time_grid.SetColSize(col, width)
+        check_time_grid.SetMinSize((460, 400))
 
         main_app_badge = self.get_entered_badge()
-        badge_input = wx.TextCtrl(checktime_dlg, size=(200, -1))
-        badge_input.Bind(wx.EVT_TEXT, badge_change)
+        badge_input = DebouncedTextCtrl(checktime_dlg, delay=0.2,
+                                        size=(200, -1))
+        badge_input.Bind(EVT_DEBOUNCED_TEXT,
+                         lambda event: show_badge(event.GetText()))
+        summary_label = wx.StaticText(checktime_dlg, label='')
         submit_btn = wx.Button(checktime_dlg, label='Close',
                                size=(80, 80))
         submit_btn.Bind(wx.EVT_BUTTON,
@@ -640,14 +1000,16 @@ class MainWindow(wx.Frame):
         vbox.AddSpacer(20)
         vbox.Add(badge_input)
         vbox.AddSpacer(20)
-        vbox.Add(check_time_grid, flag=wx.EXPAND)
+        vbox.Add(summary_label, flag=wx.EXPAND)
+        vbox.AddSpacer(20)
+        vbox.Add(check_time_grid, 1, flag=wx.EXPAND)
         vbox.AddSpacer(20)
         vbox.Add(submit_btn)
 
-        badge_input.SetValue(main_app_badge)
+        badge_input.ChangeValue(main_app_badge)
+        show_badge(main_app_badge)
 
-
-        # Fit the grid to the size of the window
+        # Size the dialog once; new lookups don't resize it.
         checktime_dlg.SetSizerAndFit(vbox)
         checktime_dlg.Layout()
         checktime_dlg.Update()
@@ -724,49 +1086,43 @@ class MainWindow(wx.Frame):
             wx.PostEvent(self.badge_num_input, evt)
 
     def update_find_user_search(self, search_text):
-        matches = {}
-        self.find_user_badge_sizer.Clear(True)
-        for num, b in self.find_user_badges.items():
-            if search_text in b['display_name'].lower():
-                matches[num] = b
-                vbox = self.create_badge_card(num,
-                                              self.scrolled_window,
-                                              self.set_badge_input)
-                self.find_user_badge_sizer.Add(vbox, 0, wx.ALL, border=10)
-        self.find_user_dlg.Fit()
-        self.find_user_dlg.Layout()
-        self.find_user_dlg.Update()
+        # The dialog is sized once; only the cards' contents change.
+        matches = self.find_user_index.search(search_text)
+        self.find_user_results.set_results(matches,
+                                           self.find_user_index.source)
 
     def find_user_input_change(self, event):
-        search_text = event.GetString().lower()
-        self.update_find_user_search(search_text)
+        self.update_find_user_search(event.GetText())
 
     @return_focus
     def find_user(self, event):
         self.update_active_badges()
         badges = libtt.get_badges()
-        badges = dict(sorted(badges.items(), key=lambda x: x[1]['display_name']))
-        self.find_user_badges = badges
-        if len(self.find_user_badges) == 0:
+        if len(badges) == 0:
             wx.MessageBox('There are no users in the system.',
                           'Error', wx.OK | wx.ICON_ERROR)
             return
+        # The index is kept until the badges change
+        generation = libtt.badges_generation()
+        if self.find_user_index is None or \
+                self.find_user_index.source is not badges or \
+                self.find_user_index.generation != generation:
+            self.find_user_index = libsearch.NameIndex(badges, generation)
         self.find_user_dlg = wx.Dialog(self, title='Find User')
 
-        search_input = wx.TextCtrl(self.find_user_dlg, size=(200, -1))
-        search_input.Bind(wx.EVT_TEXT, self.find_user_input_change)
-        self.scrolled_window = wx.ScrolledWindow(self.find_user_dlg)
-        self.scrolled_window.SetScrollRate(10, 10)
-        self.scrolled_window.SetMinSize((800, 600))
-        self.find_user_badge_sizer = wx.WrapSizer(wx.HORIZONTAL)
-        self.scrolled_window.SetSizer(self.find_user_badge_sizer)
+        search_input = DebouncedTextCtrl(self.find_user_dlg, delay=0.15,
+                                         size=(200, -1))
+        search_input.Bind(EVT_DEBOUNCED_TEXT, self.find_user_input_change)
+        self.find_user_results = BadgeCardPool(
+            self.find_user_dlg,
+            lambda badge_num: self.set_badge_input(None, badge_num))
 
         vbox = wx.BoxSizer(wx.VERTICAL)
         vbox.SetMinSize((600, -1))
         vbox.AddSpacer(20)
         vbox.Add(search_input)
         vbox.AddSpacer(20)
-        vbox.Add(self.scrolled_window, flag=wx.EXPAND, border=10)
+        vbox.Add(self.find_user_results, flag=wx.EXPAND, border=10)
         vbox.AddSpacer(20)
         self.update_find_user_search('')
         self.find_user_dlg.SetSizerAndFit(vbox)
@@ -777,9 +1133,35 @@ class MainWindow(wx.Frame):
 
     @return_focus
     def punch_all_out(self, event):
-        for badge_num, badge in libtt.get_badges().items():
-            if badge['status'] == 'in':
-                self.punch_out(None, badge_num)
+        badges = [badge_num for badge_num, badge in libtt.get_badges().items()
+                  if badge['status'] == 'in']
+        if len(badges) == 0:
+            return
+        dt = datetime.now()
+        closed = libtt.punch_out_many(badges, dt)
+        if azure_enabled():
+            msg = TriTimeEvent(
+                system_id=system_id(),
+                badge_num=None,
+                event_type='punch_out_many',
+                ts=dt,
+                details={'badges': closed}
+            )
+            libaz.message_queue.put(msg)
+            # Kiosks that predate punch_out_many ignore it, so each badge
+            # goes out as an ordinary punch_out too. Those are marked as
+            # part of the bulk one so kiosks that know it skip them.
+            for badge in closed:
+                libaz.message_queue.put(TriTimeEvent(
+                    system_id=system_id(),
+                    badge_num=badge,
+                    event_type='punch_out',
+                    ts=dt,
+                    details={'bulk': True}
+                ))
+        # One grid rebuild for the lot rather than one per badge
+        self.update_active_badges()
+        self.clear_input()
 
     def add_azure_settings(self, dlg, vbox, spacer_size, keys, vfuncs):
         # create text inputs for machine name, system name, and endpoint then
@@ -810,6 +1192,7 @@ class MainWindow(wx.Frame):
         for k, v in zip(keys, vfuncs):
             _app_settings[k] = v()
         store_app_settings()
+        self.schedule_auto_out()
         self.settings_dlg.EndModal(True)
 
     @return_focus
@@ -900,28 +1283,52 @@ class MainWindow(wx.Frame):
         self.settings_dlg.Destroy()
 
     def update_image_cache(self, event, gauge, status):
-        import shutil
-        shutil.rmtree('cached_photos')
-        os.makedirs('cached_photos')
-        self.download_all_images(gauge, status)
-
-    def download_all_images(self, gauge: wx.Gauge, status: wx.StaticText):
+        # Photos are brought up to date in the background; the kiosk keeps
+        # working and the gauge follows along.
+        if self.photo_thread is not None and self.photo_thread.is_alive():
+            status.SetLabel('Already updating images...')
+            return
         badges = libtt.get_badges()
-        status.SetLabel(f'0 of {len(badges)} images downloaded')
-        for idx, (badge_num, badge) in enumerate(badges.items()):
-            time.sleep(0.1)
-            img_url = badge['photo_url']
-            img, should_cache = download_image(img_url)
-            if should_cache:
-                if not os.path.exists('cached_photos'):
-                    os.makedirs('cached_photos')
-                img.SaveFile(f'cached_photos/{badge_num}.png',
-                             wx.BITMAP_TYPE_PNG)
-            gauge.SetValue(idx)
-            status.SetLabel(f'{idx+1} of {len(badges)} images downloaded')
-            wx.Yield()
-        return
-
+        gauge.SetRange(max(len(badges), 1))
+        gauge.SetValue(0)
+        status.SetLabel(f'0 of {len(badges)} images checked')
+        self.photo_thread = Thread(target=self.download_all_images,
+                                   args=(badges, gauge, status), daemon=True)
+        self.photo_thread.start()
+
+    # Runs on self.photo_thread
+    def download_all_images(self, badges, gauge: wx.Gauge,
+                            status: wx.StaticText):
+        def progress(done, total, badge_num, result):
+            wx.CallAfter(self.show_download_progress, gauge, status,
+                         done, total, badge_num, result)
+        results = self.photo_downloader.download_all(badges, progress)
+        wx.CallAfter(self.images_downloaded, status, results)
+
+    def show_download_progress(self, gauge, status, done, total, badge_num,
+                               result):
+        if result == 'downloaded':
+            photo_cache.invalidate(badge_num)
+        # The settings dialog may have been closed in the meantime
+        if gauge:
+            gauge.SetValue(done)
+        if status:
+            status.SetLabel(f'{done} of {total} images checked')
+
+    def images_downloaded(self, status, results):
+        counts = {}
+        for result in results.values():
+            counts[result] = counts.get(result, 0) + 1
+        if status:
+            status.SetLabel(
+                f'{counts.get("downloaded", 0)} downloaded, '
+                f'{counts.get("unchanged", 0)} unchanged, '
+                f'{counts.get("failed", 0)} failed'
+            )
+        if counts.get('downloaded', 0) > 0:
+            # Redraw the cards so they pick up the new photos
+            self.clear_active_badges()
+            self.update_active_badges()
 
 
 def azure_enabled() -> bool:
@@ -931,28 +1338,41 @@ def azure_enabled() -> bool:
 def azure_message_handler(frame: MainWindow, message: TriTimeEvent) -> None:
     # message: TriTimeEvent = TriTimeEvent.from_dict(payload)
     update_badges = False
+    if message.event_type in ('punch_in', 'punch_out') and \
+            message.badge_num not in libtt.get_badges():
+        print(f'skipping {message.event_type} for unknown badge '
+              f'{message.badge_num}')
+        return
     if message.event_type == 'punch_in':
-        badges = libtt.punch_in(message.badge_num, message.ts)
-        libtt.store_badges(badges)
+        libtt.punch_in(message.badge_num, message.ts)
         update_badges = True
     elif message.event_type == 'punch_out':
-        badges = libtt.punch_out(message.badge_num, message.ts)
-        libtt.store_badges(badges)
-        libtt.tabulate_badge(message.badge_num)
+        if (message.details or {}).get('bulk'):
+            # Already covered by the punch_out_many sent with it
+            return
+        libtt.punch_out(message.badge_num, message.ts)
+        update_badges = True
+    elif message.event_type == 'punch_out_many':
+        libtt.punch_out_many(message.details['badges'], message.ts)
         update_badges = True
     elif message.event_type == 'badges_sync':
         badge_data = message.details
         libtt.store_badges(badge_data)
         update_badges = True
     elif message.event_type == 'punch_data_sync':
-        badge_num = message.badge_num
-        punch_data = message.details
-        libtt.write_punches(badge_num, punch_data)
+        libtt.write_punches(message.badge_num, message.details)
+    elif message.event_type == 'punch_range_sync':
+        # Only a slice of the history was sent; replace just that part.
+        libtt.write_punches_range(message.badge_num, message.details['start'],
+                                  message.details['end'],
+                                  message.details['punches'])
     if update_badges:
         wx.CallAfter(frame.update_active_badges)
 
 # Here's how we fire up the wxPython app
 if __name__ == '__main__':
+    # Needed for the export worker process in a PyInstaller build
+    multiprocessing.freeze_support()
     import sys
     if hasattr(sys, 'frozen'):
         import pyi_splash
@@ -961,6 +1381,10 @@ if __name__ == '__main__':
     if _app_settings is None:
         _app_settings = default_app_settings()
         store_app_settings()
+    libtt.use_backend(_app_settings.get('storage_backend', 'json'))
+    print(libtt.fix_badges().summary())
+    libtt.archive_closed_periods(_app_settings.get('pay_period_days', 14))
+    libtr.rollups.period_days = _app_settings.get('pay_period_days', 14)
     app = wx.App()
     frame = MainWindow(parent=None, id=-1)
     if azure_enabled():